@@ -0,0 +1,494 @@
+from array import array
+from math import sqrt
+from math import log
+import CubiCupMCTS
+import CubiCupState
+import Network
+from CubiCupDriver import BLUE
+
+NO_NODE = -1  # Index used for a missing parent, child or terminal child
+
+
+# MCTS tree stored as parallel arrays, one entry per node, instead of one Node object per node. Nodes
+# don't keep a State, positions are rebuilt by following moves down from the root state. A node's
+# children are created all at once, in one block of entries starting at firstChild, when it is expanded.
+class ArrayTree:
+
+    # Column name -> array type code and starting value, for every per node array
+    columns = {
+        "parent": ("i", NO_NODE),
+        "move": ("i", 0),  # Topology index of the move that led to this node
+        "actionFor": ("b", 0),  # Player who made that move
+        "sims": ("i", 0),
+        "score": ("d", 0.0),
+        "prior": ("f", 1.0),  # Probability of the move from the network, 1 without one
+        "firstChild": ("i", NO_NODE),  # NO_NODE until expanded
+        "childCount": ("i", 0),
+        "isTerminal": ("b", 0),
+        "terminalBlue": ("f", 0.0),
+        "terminalGreen": ("f", 0.0),
+        "terminalScore": ("f", -float("inf")),
+        "terminalChild": ("i", NO_NODE),
+    }
+
+    # Columns that aren't node indices, and can be copied as is to a new tree
+    valueColumns = ("move", "actionFor", "sims", "score", "prior", "isTerminal", "terminalBlue", "terminalGreen",
+                    "terminalScore")
+
+    def __init__(self, rootState, moveProbFunc=None, capacity=4096):
+        self.explore = 2
+        self.moveProbFunc = moveProbFunc
+        self.rootState = rootState
+        self.topology = rootState.topology
+        self.capacity = 0
+        self.size = 0
+
+        for name, (typeCode, initial) in self.columns.items():
+            setattr(self, name, array(typeCode))
+        self.grow(capacity)
+
+        # Root is made the way Node does it, starting at 1 simulation
+        self.root = self.allocate(1)
+        self.actionFor[self.root] = rootState.lastTurn()
+        self.sims[self.root] = 1
+        self.setTerminalFromState(self.root, rootState)
+
+    # Bytes used by the arrays for each node
+    @classmethod
+    def bytesPerNode(cls):
+        return sum(array(typeCode).itemsize for typeCode, initial in cls.columns.values())
+
+    # Make room for count more nodes
+    def grow(self, count):
+        for name, (typeCode, initial) in self.columns.items():
+            getattr(self, name).extend(array(typeCode, [initial]) * count)
+        self.capacity += count
+
+    # Allocate count consecutive nodes, doubling the arrays when they're full, returns the first index
+    def allocate(self, count):
+        if self.size + count > self.capacity:
+            self.grow(max(self.capacity, count))
+        first = self.size
+        self.size += count
+        return first
+
+    def setTerminalFromState(self, node, state):
+        if state.gameOver:
+            self.isTerminal[node] = 1
+            self.terminalBlue[node] = state.endValue[0]
+            self.terminalGreen[node] = state.endValue[1]
+            self.terminalScore[node] = state.endValue[state.turn]
+
+    def getTerminalValue(self, node):
+        return self.terminalBlue[node], self.terminalGreen[node]
+
+    def isExpanded(self, node):
+        return self.firstChild[node] != NO_NODE
+
+    # Create the children of node, one for each available move of state (the position at node), with
+    # priors from the network if there is one
+    def expand(self, node, state):
+
+        moves = state.availableMoves
+        first = self.allocate(len(moves))
+
+        if self.moveProbFunc is not None:
+            priors = Network.getCachedMoveProbs(state, self.moveProbFunc)
+        else:
+            priors = None
+
+        indexOf = self.topology.indexOf
+        for i in range(len(moves)):
+            child = first + i
+            self.parent[child] = node
+            self.move[child] = indexOf[moves[i]]
+            self.actionFor[child] = state.turn
+            if priors is not None:
+                self.prior[child] = priors[i]
+
+        self.firstChild[node] = first
+        self.childCount[node] = len(moves)
+
+    # Get the child to search next by UCT, the same way Node.getChildToExpandIndex does
+    def getChildToExpand(self, node):
+
+        maxUCT = -float("inf")
+        bestChild = NO_NODE
+        logSims = log(self.sims[node])
+        first = self.firstChild[node]
+
+        for child in range(first, first + self.childCount[node]):
+            childSims = self.sims[child]
+            if childSims == 0:
+                if self.moveProbFunc is None:
+                    # No child probs and child not searched yet, just greedy explore
+                    return child
+                # Use UCT without win percent, just explore/probability
+                UCT = self.explore * self.prior[child] * sqrt(logSims)
+            else:
+                UCT = self.score[child] / childSims + self.explore * self.prior[child] * sqrt(logSims / childSims)
+
+            if UCT >= maxUCT:
+                maxUCT = UCT
+                bestChild = child
+
+        return bestChild
+
+    # Check to see if node is terminal, a child proven a win for it or every child proven. Simpler than the
+    # bounds Node keeps, each node here only costs its few arrays
+    def checkForTerminal(self, node):
+
+        allChildrenTerminal = True
+        first = self.firstChild[node]
+
+        for child in range(first, first + self.childCount[node]):
+            # Children are only marked terminal once they've been reached
+            if self.isTerminal[child]:
+                childScore = self.getTerminalValue(child)[self.actionFor[child]]
+                if childScore >= self.terminalScore[node]:
+                    self.terminalChild[node] = child
+                    self.terminalBlue[node] = self.terminalBlue[child]
+                    self.terminalGreen[node] = self.terminalGreen[child]
+                    self.terminalScore[node] = childScore
+            else:
+                allChildrenTerminal = False
+
+        if allChildrenTerminal or self.terminalScore[node] >= 1:
+            self.isTerminal[node] = 1
+
+    def getWinChance(self, node):
+        return self.score[node] / max(self.sims[node], 1)
+
+    # Get the best child of node, the same way Node.getBestChild does
+    def getBestChild(self, node):
+
+        if self.isTerminal[node] and self.terminalScore[node] > 0:
+            return self.terminalChild[node]
+
+        currentMaxWin = -float("inf")
+        bestChild = NO_NODE
+        first = self.firstChild[node]
+        if first == NO_NODE:
+            return NO_NODE
+
+        for child in range(first, first + self.childCount[node]):
+            if self.sims[child] > 0 and self.getWinChance(child) > currentMaxWin:
+                currentMaxWin = self.getWinChance(child)
+                bestChild = child
+
+        return bestChild
+
+    # Get the score of node, the same way Node.getScore does
+    def getScore(self, node):
+
+        # The player to move at node is the one that didn't make the move leading to it
+        turnIsBlue = self.actionFor[node] != BLUE
+
+        if self.isTerminal[node]:
+            terminalScore = self.terminalScore[node]
+            if terminalScore == 0.5:
+                return 0
+            elif terminalScore >= 1:
+                return 1 if turnIsBlue else -1
+            elif terminalScore <= 0:
+                return -1 if turnIsBlue else 1
+
+        if self.actionFor[node] == BLUE:
+            return 2 * self.getWinChance(node) - 1
+        else:
+            return - (2 * self.getWinChance(node) - 1)
+
+    # Find the child of node reached by move (an x,y,z tuple), or NO_NODE
+    def findChild(self, node, move):
+        index = self.topology.indexOf[move]
+        first = self.firstChild[node]
+        if first == NO_NODE:
+            return NO_NODE
+        for child in range(first, first + self.childCount[node]):
+            if self.move[child] == index:
+                return child
+        return NO_NODE
+
+    # Get the moves from the root to node, as x,y,z tuples
+    def getPath(self, node):
+        path = []
+        while node != self.root and node != NO_NODE:  # Parents come before children, so this always ends
+            path.append(self.topology.coords[self.move[node]])
+            node = self.parent[node]
+        path.reverse()
+        return path
+
+    # Rebuild the position at node by playing the moves to it on a copy of the root state
+    def getState(self, node):
+        state = CubiCupState.State(self.rootState.boardSize, self.rootState)
+        for move in self.getPath(node):
+            state.takeTurn(move)
+        return state
+
+    # Make node the root, copying its subtree into fresh arrays so everything else is freed
+    def reroot(self, node):
+
+        newRootState = self.getState(node)
+        oldColumns = {name: getattr(self, name) for name in self.columns}
+
+        self.rootState = newRootState
+        self.capacity = 0
+        self.size = 0
+        for name, (typeCode, initial) in self.columns.items():
+            setattr(self, name, array(typeCode))
+        self.grow(max(64, len(oldColumns["parent"]) // 2))
+
+        self.root = self.allocate(1)
+        copies = [(node, self.root)]
+
+        # Each node's children are copied as one block, so they stay together. Parent, first child and
+        # terminal child are indices, they're set from the new indices instead of copied
+        while copies:
+            oldNode, newNode = copies.pop()
+            for name in self.valueColumns:
+                getattr(self, name)[newNode] = oldColumns[name][oldNode]
+
+            oldFirst = oldColumns["firstChild"][oldNode]
+            if oldFirst != NO_NODE:
+                count = oldColumns["childCount"][oldNode]
+                newFirst = self.allocate(count)
+                self.firstChild[newNode] = newFirst
+                self.childCount[newNode] = count
+                for i in range(count):
+                    copies.append((oldFirst + i, newFirst + i))
+                    self.parent[newFirst + i] = newNode
+
+            oldTerminalChild = oldColumns["terminalChild"][oldNode]
+            if oldTerminalChild != NO_NODE:
+                self.terminalChild[newNode] = self.firstChild[newNode] + (oldTerminalChild - oldFirst)
+
+
+# View of one node of an ArrayTree with the parts of the Node API used outside the search (engine output,
+# players, root parallel workers). Views are made when asked for and are only good until the root changes, the search itself only uses
+# indices.
+class ArrayNode:
+
+    # Every move is searched here, none stand in for their symmetric moves
+    symmetricTo = None
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    def __eq__(self, other):
+        return isinstance(other, ArrayNode) and other.tree is self.tree and other.index == self.index
+
+    @property
+    def state(self):
+        if self.index == self.tree.root:
+            return self.tree.rootState
+        return self.tree.getState(self.index)
+
+    @property
+    def move(self):
+        if self.index == self.tree.root:
+            return self.tree.rootState.lastMove
+        return self.tree.topology.coords[self.tree.move[self.index]]
+
+    @property
+    def parent(self):
+        parent = self.tree.parent[self.index]
+        return None if parent == NO_NODE else ArrayNode(self.tree, parent)
+
+    @property
+    def children(self):
+        first = self.tree.firstChild[self.index]
+        if first == NO_NODE:
+            return []
+        return [ArrayNode(self.tree, child) if self.tree.sims[child] > 0 else None
+                for child in range(first, first + self.tree.childCount[self.index])]
+
+    @property
+    def sims(self):
+        return self.tree.sims[self.index]
+
+    @property
+    def score(self):
+        return self.tree.score[self.index]
+
+    @property
+    def actionFor(self):
+        return self.tree.actionFor[self.index]
+
+    @property
+    def isTerminal(self):
+        return bool(self.tree.isTerminal[self.index])
+
+    @property
+    def terminalValue(self):
+        return self.tree.getTerminalValue(self.index) if self.isTerminal else None
+
+    @property
+    def terminalScore(self):
+        return self.tree.terminalScore[self.index]
+
+    @property
+    def terminalChild(self):
+        child = self.tree.terminalChild[self.index]
+        return None if child == NO_NODE else ArrayNode(self.tree, child)
+
+    def getWinChance(self):
+        return self.tree.getWinChance(self.index)
+
+    def getScore(self):
+        return self.tree.getScore(self.index)
+
+    def getBestChild(self):
+        child = self.tree.getBestChild(self.index)
+        return None if child == NO_NODE else ArrayNode(self.tree, child)
+
+    def getChildMove(self, child):
+        return child.move
+
+    # Get the moves, in the same order as children
+    def getMoves(self):
+        first = self.tree.firstChild[self.index]
+        if first == NO_NODE:
+            return []
+        coords = self.tree.topology.coords
+        return [coords[self.tree.move[child]] for child in range(first, first + self.tree.childCount[self.index])]
+
+    def getMoveProbabilities(self):
+
+        size = self.tree.rootState.boardSize
+
+        moveProbs = [[[0 for x in range(size + 1)] for y in range(size + 1)] for z in range(size + 1)]
+
+        first = self.tree.firstChild[self.index]
+        if first == NO_NODE:
+            return moveProbs
+
+        for child in range(first, first + self.tree.childCount[self.index]):
+            x, y, z = self.tree.topology.coords[self.tree.move[child]]
+            # A root made for a move the search hadn't reached starts without the extra simulation
+            moveProbs[x][y][z] = self.tree.sims[child] / max(self.sims - 1, 1)
+
+        return moveProbs
+
+
+# MCTS over an ArrayTree. It's driven the same way as MCTS (run, pause, updateWithTurn, reset, end) and its
+# root is an ArrayNode, but selection, simulation and backpropagation only pass node indices around.
+# Searches with a single worker.
+class ArrayMCTS(CubiCupMCTS.MCTS):
+
+    def __init__(self, size, moveProbFunc=None, rolloutGames=1, capacity=4096):
+        CubiCupMCTS.MCTS.__init__(self, size, rolloutGames=rolloutGames)
+        self.moveProbFunc = moveProbFunc
+        self.capacity = capacity
+        self.resetMCTS()  # Replaces the Node root with an ArrayTree
+
+    def resetMCTS(self):
+        # Reset all parameters
+        newGameState = CubiCupState.State(self.gameSize)
+        self.tree = ArrayTree(newGameState, self.moveProbFunc, self.capacity)
+        self.root = ArrayNode(self.tree, self.tree.root)
+        self.scratch = CubiCupState.State(self.gameSize, newGameState)
+        self.rolloutState = CubiCupState.State(self.gameSize, newGameState)
+        self.newRoot = None
+        self.newRootReady = False
+        self.reset = False
+        self.simsSinceLastMove = 0
+        self.pause = False
+        self.kill = False
+        self.isPaused = False
+
+    # Set the new root to the child reached by move. A move the search never tried may not have a node yet if the
+    # root hasn't been expanded, updateRoot makes it (as newRoot is None), the tree only changes in the search
+    def findNewRoot(self, move):
+        child = self.tree.findChild(self.tree.root, move)
+        if child != NO_NODE:
+            self.newRoot = ArrayNode(self.tree, child)
+        else:
+            self.newRoot = None
+        self.newRootMove = move
+        self.newRootReady = True
+        self.simsSinceLastMove = 0
+
+    def updateRoot(self):
+
+        if not (self.newRootReady or self.reset):
+            return
+
+        with self.control:
+
+            if self.newRootReady:
+                tree = self.tree
+                if self.newRoot is None:
+                    tree.expand(tree.root, tree.rootState)
+                    self.newRoot = ArrayNode(tree, tree.findChild(tree.root, self.newRootMove))
+                tree.reroot(self.newRoot.index)
+                if not tree.isExpanded(tree.root):
+                    # Never reached, or reached but not expanded, start it like a new root so its simulations
+                    # don't count towards searching it, and check the game isn't over
+                    tree.sims[tree.root] = 1
+                    tree.score[tree.root] = 0
+                    tree.setTerminalFromState(tree.root, tree.rootState)
+                self.root = ArrayNode(tree, tree.root)
+                self.scratch = CubiCupState.State(self.gameSize, tree.rootState)
+                self.newRoot = None
+                self.newRootReady = False
+
+            if self.reset:
+                self.resetMCTS()
+
+            self.control.notify_all()
+
+    # Walk down from node (an index, or the root view) to the node to expand, following along on scratch.
+    # The array tree is always a tree, parents are enough to backpropagate, so path isn't used
+    def selectNodeToExpand(self, node, scratch=None, path=None):
+
+        tree = self.tree
+        if scratch is None:
+            scratch = self.scratch
+        if isinstance(node, ArrayNode):
+            node = node.index
+
+        coords = tree.topology.coords
+
+        while not tree.isTerminal[node]:
+
+            if not tree.isExpanded(node):
+                tree.expand(node, scratch)
+
+            child = tree.getChildToExpand(node)
+            scratch.makeMove(coords[tree.move[child]])
+
+            if tree.sims[child] == 0:
+                # First time reaching child, the scratch state tells us if it ends the game
+                tree.setTerminalFromState(child, scratch)
+                return child
+
+            node = child
+
+        return node
+
+    # Nodes here are indices into the tree's arrays
+    def getKnownValue(self, node):
+        if isinstance(node, ArrayNode):
+            node = node.index
+        return self.tree.getTerminalValue(node) if self.tree.isTerminal[node] else None
+
+    def backPropagate(self, endValue, node, virtualLoss=0, path=None):
+
+        tree = self.tree
+        if isinstance(node, ArrayNode):
+            node = node.index
+
+        while node != tree.root:
+
+            parent = tree.parent[node]
+            if tree.isTerminal[node]:
+                # If this node is terminal, check to see if the parent is as well
+                tree.checkForTerminal(parent)
+
+            tree.sims[node] += 1
+            tree.score[node] += endValue[tree.actionFor[node]]
+            node = parent
+
+        tree.sims[node] += 1
+        tree.score[node] += endValue[tree.actionFor[node]]
@@ -0,0 +1,125 @@
+import os
+import pickle
+import sys
+import CubiCupMCTS
+from CubiCupDriver import invertPermutation
+from CubiCupDriver import permuteMove
+
+
+# Get the name of the opening book file of a board size, in directory
+def getBookName(size, directory=""):
+    return os.path.join(directory, "book_" + str(size) + ".pkl")
+
+
+# Statistics of deep searches of the first moves of a board size, so a search starting from one of those
+# positions doesn't have to work them out again. Positions are kept by canonical hash, with their moves turned
+# the canonical way, so a position is found however it's turned
+class Book:
+
+    # positions is a dict of canonical hash -> list of (index of a move in the canonical orientation,
+    # simulations of the move, score of the move for the player making it)
+    def __init__(self, size, positions):
+        self.size = size
+        self.positions = positions
+
+    # Get the book's list of (move, simulations, score) for state, with the moves in state's orientation, or
+    # None if the book doesn't have state
+    def probe(self, state):
+
+        if state.boardSize != self.size:
+            return None
+
+        key, permutation = state.getCanonical()
+        entry = self.positions.get(key)
+        if entry is None:
+            return None
+
+        coords = state.topology.coords
+        inverse = invertPermutation(permutation)
+        return [(permuteMove(coords[moveIndex], inverse), sims, score) for moveIndex, sims, score in entry]
+
+    # Add the statistics of the root's children of a search, for the root's position. The root's state and
+    # moves are both in the tree's orientation, so they're used as they are
+    def addSearch(self, mcts):
+
+        root = mcts.root
+        state = root.state
+        key, permutation = state.getCanonical()
+        indexOf = state.topology.indexOf
+
+        entry = []
+        for child in root.children:
+            if child is not None and child.sims > 0:
+                move = root.getChildMove(child)
+                entry.append((indexOf[permuteMove(move, permutation)], child.sims, child.score))
+
+        self.positions[key] = entry
+
+    def write(self, fileName):
+        with open(fileName, "wb") as file:
+            pickle.dump((self.size, self.positions), file)
+
+
+# Open the opening book file fileName, None if there isn't one
+def openBook(fileName):
+
+    if not os.path.exists(fileName):
+        return None
+
+    with open(fileName, "rb") as file:
+        size, positions = pickle.load(file)
+    return Book(size, positions)
+
+
+# Build an opening book for a board size, searching each position of the first plies moves for sims
+# simulations. Only moves getting at least minShare of a position's simulations are followed to the next
+# ply, the others won't be played, so they aren't worth searching deeply. Any other arguments are for the MCTS
+def buildBook(size, plies, sims, minShare=0.1, **mctsArgs):
+
+    book = Book(size, {})
+
+    # Positions of the next ply to search, as the moves reaching them
+    lines = [[]]
+    for ply in range(plies):
+
+        nextLines = []
+        for line in lines:
+
+            mcts = CubiCupMCTS.MCTS(size, **mctsArgs)
+            for move in line:
+                mcts.advance(move)
+
+            state = mcts.root.state
+            if state.gameOver or state.getCanonical()[0] in book.positions:
+                # The same position turned some way has already been searched
+                continue
+
+            mcts.search(sims)
+            book.addSearch(mcts)
+
+            root = mcts.root
+            for child in root.children:
+                if child is not None and child.sims >= minShare * root.sims:
+                    nextLines.append(line + [mcts.toGameMove(root.getChildMove(child))])
+
+        lines = nextLines
+
+    return book
+
+
+# Build the opening book of a board size, writing it to the current directory. Arguments are the size, the
+# plies to search and the simulations to search each position for
+def main():
+
+    size = int(sys.argv[1])
+    plies = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    sims = int(sys.argv[3]) if len(sys.argv) > 3 else 100000
+
+    book = buildBook(size, plies, sims)
+    fileName = getBookName(size)
+    book.write(fileName)
+    print("Wrote", len(book.positions), "positions of size", size, "to", fileName)
+
+
+if __name__ == "__main__":
+    main()
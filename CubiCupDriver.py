@@ -2,6 +2,48 @@ EMPTY = -2  # Empty cube spots are set to -2
 BASE = -1  # Base cubes spots are set to -1
 BLUE = 0  # Blue cubes spots are set to 0, this is also the array index for blue in pieces[]
 GREEN = 1  # Blue cubes spots are set to 1, this is also the array index for green in pieces[]
+OCCUPIED = 2  # Index of the occupancy bitboard in board[], a bit is set for every non-empty cube spot
+
+# The board is stored as a list of three bitboards: board[BLUE], board[GREEN] and board[OCCUPIED].
+# Cube spot (x,y,z) is bit ((x*(size+1) + y)*(size+1) + z), so the three cubes underneath a spot are
+# always (size+1)^2, (size+1) and 1 bits above it. Python ints are immutable, so copying a board is
+# just copying this three element list.
+
+
+# Get the bit index of cube spot x,y,z
+def cellIndex(size, x, y, z):
+    return (x * (size + 1) + y) * (size + 1) + z
+
+
+# Get the x,y,z tuple of a bit index
+def cellCoords(size, index):
+    xy, z = divmod(index, size + 1)
+    x, y = divmod(xy, size + 1)
+    return x, y, z
+
+
+# Get the x,y,z tuple of move with its axes permuted, permutation is a tuple of which of move's axes goes in
+# each place, like (2, 0, 1) for (z, x, y)
+def permuteMove(move, permutation):
+    return move[permutation[0]], move[permutation[1]], move[permutation[2]]
+
+
+# Get the permutation doing permutation first and then nextPermutation
+def composePermutations(permutation, nextPermutation):
+    return permutation[nextPermutation[0]], permutation[nextPermutation[1]], permutation[nextPermutation[2]]
+
+
+# Get the permutation undoing permutation
+def invertPermutation(permutation):
+    inverse = [0, 0, 0]
+    for i in range(3):
+        inverse[permutation[i]] = i
+    return tuple(inverse)
+
+
+# Create an empty board, containing no cubes at all
+def getEmptyBoard():
+    return [0, 0, 0]
 
 
 # Fill board array with base cubes
@@ -11,129 +53,172 @@ def getInitialBoard(size, board):
         y = size - x
         z = 0
         while y >= 0:
-            board[x][y][z] = BASE
+            board[OCCUPIED] |= 1 << cellIndex(size, x, y, z)
             y -= 1
             z += 1
         x += 1
 
 
-# Add move to board
-def addMoveToBoard(board, x, y, z, turn, pieces):
+# Get the value (EMPTY, BASE, BLUE or GREEN) of cube spot x,y,z
+def getCube(board, size, x, y, z):
+    bit = 1 << cellIndex(size, x, y, z)
+    if board[BLUE] & bit:
+        return BLUE
+    elif board[GREEN] & bit:
+        return GREEN
+    elif board[OCCUPIED] & bit:
+        return BASE
+    return EMPTY
+
 
-    # this is commented out because moves are based on available ones, so they are
-    # guaranteed to be legal, but I'll leave this in just in case we ever change that
+# Convert a board to a (size+1)^3 nested list of EMPTY/BASE/BLUE/GREEN values, used as network input
+def boardToArray(board, size):
+    return [[[getCube(board, size, x, y, z) for z in range(size + 1)] for y in range(size + 1)] for x in range(size + 1)]
 
-    # cant play if top is full
-    #if board[0][0][0] != EMPTY:
-    #    return
 
-    # cant play out of bounds
-    #if x < 0 or y < 0 or z < 0:
-    #    return
+# Convert a (size+1)^3 nested list (or array) of EMPTY/BASE/BLUE/GREEN values back to a board
+def boardFromArray(array, size):
+    board = getEmptyBoard()
+    for x in range(size + 1):
+        for y in range(size + 1):
+            for z in range(size + 1):
+                value = array[x][y][z]
+                if value != EMPTY:
+                    bit = 1 << cellIndex(size, x, y, z)
+                    board[OCCUPIED] |= bit
+                    if value == BLUE or value == GREEN:
+                        board[int(value)] |= bit
+    return board
 
-    # cant play if no cup to put piece in
-    #if board[x + 1][y][z] == EMPTY or board[x][y + 1][z] == EMPTY or board[x][y][z + 1] == EMPTY:
-    #    return
 
-    # cant play unless open
-    #if board[x][y][z] != EMPTY:
-    #    return
+# Add move to board, at spot index of the board's topology
+def addMoveToBoard(board, index, turn, pieces):
+
+    # Moves are based on available ones, so they are guaranteed to be legal, no checks are done here
 
     # move is legal, set board spot to whoever's turn it is
-    board[x][y][z] = turn
+    bit = 1 << index
+    board[turn] |= bit
+    board[OCCUPIED] |= bit
     pieces[turn] -= 1
 
 
-# Recursively fill cups, if any exist, until all are done or a player is out of pieces
-def fill(board, x, y, z, lastTurnAdd, pieces):
-
-    filled = False
+# Recursively fill cups, if any exist, until all are done or a player is out of pieces. The index of
+# every filled spot is appended to filledCells, in the order they were filled
+def fill(board, topology, index, lastTurnAdd, pieces, filledCells):
 
     # Set fill value to opposite of last turn (BLUE = 0, GREEN = 1)
     thisTurnAdd = 1 - lastTurnAdd
 
-    # If player filling cups has pieces remaining
-    if pieces[thisTurnAdd] != 0:
-        # If the piece added to x,y,z makes a valid cup in the -x direction
-        if x > 0 and board[x - 1][y + 1][z] == board[x][y][z] and board[x - 1][y][z + 1] == board[x][y][z]:
-            # Add the piece to fill the cup and decrement players pieces
-            board[x - 1][y][z] = thisTurnAdd
-            pieces[thisTurnAdd] -= 1
-            filled = True
+    # Check the cups the piece added at index could have made, in the -x, -y, -z directions
+    for target, targetBit, partners in topology.cups[index]:
 
-            # If other player still has pieces, see if adding this pieces created a cup they can fill
-            if pieces[lastTurnAdd] != 0:
-                fill(board, x - 1, y, z, thisTurnAdd, pieces)
+        # If player filling cups has no pieces remaining, nothing else can be filled
+        if pieces[thisTurnAdd] == 0:
+            break
 
-    # If player filling cups has pieces remaining
-    if pieces[thisTurnAdd] != 0:
-        # If the piece added to x,y,z makes a valid cup in the -y direction
-        if y > 0 and board[x + 1][y - 1][z] == board[x][y][z] and board[x][y - 1][z + 1] == board[x][y][z]:
+        # If the other two spots under target are the same color as index, it's a valid cup
+        if board[lastTurnAdd] & partners == partners:
             # Add the piece to fill the cup and decrement players pieces
-            board[x][y - 1][z] = thisTurnAdd
+            board[thisTurnAdd] |= targetBit
+            board[OCCUPIED] |= targetBit
             pieces[thisTurnAdd] -= 1
-            filled = True
+            filledCells.append(target)
 
             # If other player still has pieces, see if adding this pieces created a cup they can fill
             if pieces[lastTurnAdd] != 0:
-                fill(board, x, y - 1, z, thisTurnAdd, pieces)
+                fill(board, topology, target, thisTurnAdd, pieces, filledCells)
 
-    # If player filling cups has pieces remaining
-    if pieces[thisTurnAdd] != 0:
-        # If the piece added to x,y,z makes a valid cup in the -z direction
-        if z > 0 and board[x + 1][y][z - 1] == board[x][y][z] and board[x][y + 1][z - 1] == board[x][y][z]:
-            # Add the piece to fill the cup and decrement players pieces
-            board[x][y][z - 1] = thisTurnAdd
-            pieces[thisTurnAdd] -= 1
-            filled = True
 
-            # If other player still has pieces, see if adding this pieces created a cup they can fill
-            if pieces[lastTurnAdd] != 0:
-                fill(board, x, y, z - 1, thisTurnAdd, pieces)
+# Get the Zobrist hash of a board with turn to move, from the topology's keys
+def getHash(board, topology, turn):
+
+    hash = 0
+    for color in (BLUE, GREEN):
+        keys = topology.zobrist[color]
+        cubes = board[color]
+        # Loop through set bits, lowest first
+        while cubes:
+            lowestBit = cubes & -cubes
+            hash ^= keys[lowestBit.bit_length() - 1]
+            cubes ^= lowestBit
+
+    if turn == GREEN:
+        hash ^= topology.zobristTurn
+
+    return hash
+
+
+# Get the Zobrist hashes of a board in each of its orientations, in the order of topology.permutations. The
+# hash for a permutation is the hash the board would have with its axes permuted that way
+def getSymmetricHashes(board, topology, turn):
+
+    permutedZobrist = topology.permutedZobrist
+    hashes = [0 for permutation in permutedZobrist]
+    for color in (BLUE, GREEN):
+        cubes = board[color]
+        # Loop through set bits, lowest first
+        while cubes:
+            lowestBit = cubes & -cubes
+            index = lowestBit.bit_length() - 1
+            for i in range(len(hashes)):
+                hashes[i] ^= permutedZobrist[i][color][index]
+            cubes ^= lowestBit
+
+    if turn == GREEN:
+        for i in range(len(hashes)):
+            hashes[i] ^= topology.zobristTurn
 
-    return filled
+    return hashes
+
+
+# Get a bitboard with a bit set for every available move, given a current board
+def getAvailableMask(board, topology):
+
+    occupied = board[OCCUPIED]
+
+    # A spot is available if it is empty and the three spots below it are filled
+    return ~occupied & topology.cellMask & (occupied >> topology.layerLength) \
+        & (occupied >> topology.rowLength) & (occupied >> 1)
+
+
+# Get the number of cube spots still empty, not counting the base, given a current board
+def getEmptyCount(board, topology):
+    return bin(topology.cellMask & ~board[OCCUPIED]).count("1")
 
 
 # Fill an array with the available moves, given a current board
-def getAvailableMoves(board, size, moveList):
-    depth = 0
-    while depth <= size:    # Loop from top to bottom
-        x = 0
-        while x <= depth:   # Loop around x,y,z on each layer
-            y = depth - x
-            z = 0
-            while y >= 0:
-                # If all squares below are filled, and this one empty
-                if board[x][y][z] == EMPTY and board[x + 1][y][z] != EMPTY \
-                        and board[x][y + 1][z] != EMPTY and board[x][y][z + 1] != EMPTY:
-                    # Add x,y,z to move list as tuple
-                    moveList.append((x, y, z))
-                y -= 1
-                z += 1
-            x += 1
-        depth += 1
-
-
-def updateAvailableMoves(board, moveList, lastMove):
+def getAvailableMoves(board, topology, moveList):
 
-    moveList.remove(lastMove)
+    available = getAvailableMask(board, topology)
+    coords = topology.coords
+
+    # Loop through set bits, lowest first
+    while available:
+        lowestBit = available & -available
+        # Add x,y,z to move list as tuple
+        moveList.append(coords[lowestBit.bit_length() - 1])
+        available ^= lowestBit
 
-    x = lastMove[0]
-    y = lastMove[1]
-    z = lastMove[2]
 
-    # If the piece added to x,y,z makes a valid cup in the -x direction
-    if x > 0 and board[x - 1][y + 1][z] != EMPTY and board[x - 1][y][z + 1] != EMPTY:
-        # We created a cup, and therefore a move
-        moveList.append((x-1, y, z))
+# Update a move list after lastMove was taken and the spots in filledCells were filled by cups. A filled
+# cup was never an available move, since the last spot under it was only just filled, so the only
+# changes are lastMove going away and the spots held up by the new cubes becoming available
+def updateAvailableMoves(board, topology, moveList, lastMove, filledCells=()):
+
+    moveList.remove(lastMove)
 
-    # If the piece added to x,y,z makes a valid cup in the -y direction
-    if y > 0 and board[x + 1][y - 1][z] != EMPTY and board[x][y - 1][z + 1] != EMPTY:
-        # We created a cup, and therefore a move
-        moveList.append((x, y-1, z))
+    # Only spots held up by one of the new cubes can have become available
+    aboveMask = topology.aboveMask
+    candidates = aboveMask[topology.indexOf[lastMove]]
+    for index in filledCells:
+        candidates |= aboveMask[index]
 
-    # If the piece added to x,y,z makes a valid cup in the -z direction
-    if z > 0 and board[x + 1][y][z - 1] != EMPTY and board[x][y + 1][z - 1] != EMPTY:
-        # We created a cup, and therefore a move
-        moveList.append((x, y, z-1))
+    created = getAvailableMask(board, topology) & candidates
 
+    # Add each created move, lowest first
+    coords = topology.coords
+    while created:
+        lowestBit = created & -created
+        moveList.append(coords[lowestBit.bit_length() - 1])
+        created ^= lowestBit
@@ -1,28 +1,72 @@
 import sys
-import time
+import threading
 import CubiCupMCTS
+import CubiCupArrayTree
+import CubiCupRootParallel
+import CubiCupInference
+import CubiCupBook
+import CubiCupTablebase
 import Network
 
 
 class Engine:
 
-    # Initialize default values
-    def __init__(self):
+    # Initialize default values. With rootWorkers > 1, that many independent searches are run in
+    # separate processes and the values printed come from their merged root statistics. With arrayTree
+    # the search keeps its tree in arrays instead of Node objects, which takes far less memory, and with
+    # statelessNodes its nodes don't keep their own board. With transpositions, positions reached by
+    # different move orders share one node, and with symmetry moves that only differ by turning the board
+    # are searched once. workers > 1 searches the tree with that many threads, and with inferenceBatch > 1
+    # their network calls are run together in batches of up to that many. maxNodes keeps the search's tree
+    # to that many nodes, so the engine stays in a fixed amount of memory however long it searches. With
+    # endgameCells, positions with at most that many empty cube spots are solved exactly instead of simulated
+    def __init__(self, rootWorkers=1, arrayTree=False, statelessNodes=False, transpositions=False, symmetry=False,
+                 workers=1, inferenceBatch=1, maxNodes=None, endgameCells=None):
         self.bestMove = ""  # No initial random move
         self.gameSize = 0  # Game size isn't known yet
+        self.gameSizeSet = threading.Event()  # Set by the first newGame command
         self.mcts = None
+        self.rootWorkers = rootWorkers
+        self.arrayTree = arrayTree
+        self.statelessNodes = statelessNodes
+        self.transpositions = transpositions
+        self.symmetry = symmetry
+        self.workers = workers
+        self.inferenceBatch = inferenceBatch
+        self.maxNodes = maxNodes
+        self.endgameCells = endgameCells
 
     # Print the values we care about
     def printValues(self):
-        if self.mcts is not None and self.mcts.root.getBestChild() is not None:
-            output("Best Move:" + str(self.mcts.root.getBestChild().state.lastMove))
-            output("Score:" + str(self.mcts.root.getBestChild().getScore()))
-            output("Simulations:" + str(self.mcts.root.sims))
-            output("Game Size:" + str(self.gameSize))
+        if self.rootWorkers > 1:
+            self.printMergedValues()
+        elif self.mcts is not None:
+            # Nodes leaving the tree are reused, so read the root while the search can't change it
+            with self.mcts.control:
+                root = self.mcts.root
+                bestChild = root.getBestChild()
+                if bestChild is not None:
+                    output("Best Move:" + str(self.mcts.toGameMove(root.getChildMove(bestChild))))
+                    output("Score:" + str(bestChild.getScore()))
+                    output("Simulations:" + str(root.sims))
+                    output("Game Size:" + str(self.gameSize))
         else:
             pass
             #output("Error:Something is wrong")
 
+    # Print the values we care about, from the merged statistics of the root parallel workers
+    def printMergedValues(self):
+        merged = None
+        if self.mcts is not None:
+            merged = self.mcts.getMergedValues()
+
+        if merged is not None:
+            bestMove, score, sims = merged
+            output("Best Move:" + str(bestMove))
+            output("Score:" + str(score))
+            output("Simulations:" + str(sims))
+            output("Game Size:" + str(self.gameSize))
+
     # "subscribe:x" is used to tell the interfacing program which values this program will output
     def printValueDefinitions(self):
         output("subscribe:Best Move")
@@ -41,6 +85,7 @@ class Engine:
         # If first part of command is "newGame"
         if directives[0] == "newGame":
             self.gameSize = int(directives[1])  # Set self.gameSize to the second part of the command
+            self.gameSizeSet.set()
             if self.mcts is not None:
                 self.mcts.indicateReset(self.gameSize)
 
@@ -52,27 +97,52 @@ class Engine:
     def runEngine(self):
 
         # Do nothing until game size is specified
-        while self.gameSize == 0:
-            time.sleep(0.1)
-            continue
+        self.gameSizeSet.wait()
 
         modelName = "/home/guntherhuebler/PycharmProjects/CubiCupEngine/currentModel_" + str(self.gameSize) + ".h5"
 
+        if self.rootWorkers > 1:
+            # Each worker process loads the model itself, then the merged searches run until ended
+            self.mcts = CubiCupRootParallel.RootParallelMCTS(self.gameSize, self.rootWorkers, modelName)
+            self.mcts.run()
+            return
+
         # Get model from name, then get output function so predicts can be done quickly
         if modelName is not None:
-            inputShape = (1, self.gameSize + 1, self.gameSize + 1, self.gameSize + 1)
-            policyShape = (1, self.gameSize + 1, self.gameSize + 1, self.gameSize + 1)
-            model = Network.getModel(modelName, inputShape, policyShape)
-            outputFunc = Network.getOutputFunc(model)
+            outputFunc = getModelOutputFunc(modelName, self.gameSize)
+            if self.inferenceBatch > 1:
+                outputFunc = CubiCupInference.InferenceBatcher(outputFunc, self.inferenceBatch)
         else:
             outputFunc = None
 
+        # Every position of small boards is already solved if their tablebase has been generated, then moves
+        # are played from it straight away
+        tablebaseName = CubiCupTablebase.getTablebaseName(self.gameSize, "/home/guntherhuebler/PycharmProjects/CubiCupEngine")
+        tablebase = CubiCupTablebase.openTablebase(tablebaseName)
+
+        # The first moves start from the opening book's searches, if one has been built for this size
+        book = CubiCupBook.openBook(CubiCupBook.getBookName(self.gameSize, "/home/guntherhuebler/PycharmProjects/CubiCupEngine"))
+
         # Create new mcts and start running it
-        self.mcts = CubiCupMCTS.MCTS(self.gameSize, moveProbFunc=outputFunc)
+        if self.arrayTree:
+            self.mcts = CubiCupArrayTree.ArrayMCTS(self.gameSize, moveProbFunc=outputFunc)
+        else:
+            self.mcts = CubiCupMCTS.MCTS(self.gameSize, moveProbFunc=outputFunc, workers=self.workers,
+                                         statelessNodes=self.statelessNodes, transpositions=self.transpositions,
+                                         symmetry=self.symmetry, maxNodes=self.maxNodes,
+                                         endgameCells=self.endgameCells, tablebase=tablebase, book=book)
         self.mcts.run()
         return
 
 
+# Get model from name, then get output function so predicts can be done quickly
+def getModelOutputFunc(modelName, gameSize):
+    inputShape = (1, gameSize + 1, gameSize + 1, gameSize + 1)
+    policyShape = (1, gameSize + 1, gameSize + 1, gameSize + 1)
+    model = Network.getModel(modelName, inputShape, policyShape)
+    return Network.getOutputFunc(model)
+
+
 # Helper function to output a string. To interface with java, it seems we need the "sys.stdout.flush()",
 # so using this function just makes the code a little prettier
 def output(string):
@@ -1,6 +1,7 @@
-
 import CubiCupState
-import copy
+import array
+from CubiCupDriver import BLUE
+from CubiCupDriver import GREEN
 
 class Game:
 
@@ -9,11 +10,26 @@ class Game:
         self.state = CubiCupState.State(size)
         self.players = []
         self.endValue = 0
-        self.history = []
 
-    def takeTurn(self, move, moveProbs):
+        # The game's record, kept small enough to hold on to and send around: the spot index of each move, and
+        # for each move the search's visits of the moves that were available then, as (index in the available
+        # moves, visits) pairs. The pairs of move i are visitStarts[i] up to visitStarts[i + 1] in visitMoves
+        # and visitCounts. Positions are rebuilt from the moves when they're needed, see getHistory
+        self.moves = array.array("H")
+        self.visitStarts = array.array("I", [0])
+        self.visitMoves = array.array("H")
+        self.visitCounts = array.array("f")
+
+    # Take a turn with move, recording visits, the search's (move, visits) pairs for the moves available
+    def takeTurn(self, move, visits):
 
-        self.history.append((copy.deepcopy(self.state), moveProbs))
+        availableMoves = self.state.availableMoves
+        for visitedMove, count in visits:
+            if count > 0:
+                self.visitMoves.append(availableMoves.index(visitedMove))
+                self.visitCounts.append(count)
+        self.visitStarts.append(len(self.visitMoves))
+        self.moves.append(self.state.topology.indexOf[move])
 
         self.state.takeTurn(move)
 
@@ -26,13 +42,49 @@ class Game:
     def join(self, player):
         self.players.append(player)
 
+    def getNumMoves(self):
+        return len(self.moves)
+
+    # Get the state before the ith move, replaying the moves up to it
+    def getState(self, i):
+        state = CubiCupState.State(self.size)
+        for index in self.moves[:i]:
+            state.takeTurn(state.topology.coords[index])
+        return state
+
+    # Get the search's move probabilities of the ith move, from state (the state before it), as a (size+1)^3
+    # nested list like Node.getMoveProbabilities gives
+    def getMoveProbs(self, i, state):
+
+        moveProbs = [[[0 for z in range(self.size + 1)] for y in range(self.size + 1)] for x in range(self.size + 1)]
+
+        start = self.visitStarts[i]
+        end = self.visitStarts[i + 1]
+        total = sum(self.visitCounts[start:end])
+        if total == 0:
+            return moveProbs
+
+        for j in range(start, end):
+            x, y, z = state.availableMoves[self.visitMoves[j]]
+            moveProbs[x][y][z] = self.visitCounts[j] / total
+
+        return moveProbs
+
+    # Go through the game's moves, giving the state before each move and the search's move probabilities for
+    # it. The moves are replayed on one state as this goes, so a state given is only right until the next one
+    def getHistory(self):
+
+        state = CubiCupState.State(self.size)
+        for i in range(len(self.moves)):
+            yield state, self.getMoveProbs(i, state)
+            state.takeTurn(state.topology.coords[self.moves[i]])
+
+    # Get the game's result from its end value, 1 if Blue won, 0 for a tie and -1 if Green won. Wins with pieces
+    # left over give the winner more than 1 and the loser less than 0, so it's whoever got more
     def convertEndValToScore(self, endValue):
-        if endValue == (1, 0):
+        if endValue[BLUE] > endValue[GREEN]:
             return 1
-        elif endValue == (0.5, 0.5):
+        elif endValue[BLUE] == endValue[GREEN]:
             return 0
         else:
             return -1
-
-
-
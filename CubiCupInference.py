@@ -0,0 +1,94 @@
+import concurrent.futures
+import queue
+import threading
+import time
+
+
+# Runs a network's output function on batches of positions instead of one at a time. Search threads submit
+# positions and wait on a future, while a single worker thread collects submissions until it has batchSize
+# of them or timeout seconds have passed since the first, then runs them all in one model call. Most of a
+# batch-1 call is overhead, so this is what makes NN-guided search with several threads worth it.
+# Can be passed anywhere an output function is (like MCTS's moveProbFunc), Network.getMoveProbs sends
+# positions here when it gets one.
+class InferenceBatcher:
+
+    def __init__(self, outputFunc, batchSize=32, timeout=0.002):
+        self.outputFunc = outputFunc
+        self.batchSize = batchSize
+        self.timeout = timeout
+        self.requests = queue.Queue()  # (board array, moves, future) for each position waiting
+
+        self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    # Queue a state for the network, returning a future for the probabilities of moves (the state's available
+    # moves if not given), in the same order
+    def submit(self, state, moves=None):
+
+        if moves is None:
+            moves = state.availableMoves
+
+        future = concurrent.futures.Future()
+        # Moves are copied, the state's move set keeps changing after this returns
+        self.requests.put((state.getBoardArray(), tuple(moves), future))
+        return future
+
+    # Get the probabilities for moves of state, waiting for them
+    def getMoveProbs(self, state, moves=None):
+        return self.submit(state, moves).result()
+
+    # Stop the worker once the positions already submitted are done
+    def close(self):
+        self.requests.put(None)
+        self.worker.join()
+
+    def run(self):
+
+        while True:
+
+            # Wait for a first position, then take more until the batch is full or it's waited long enough
+            request = self.requests.get()
+            if request is None:
+                return
+
+            batch = [request]
+            deadline = time.time() + self.timeout
+            stop = False
+            while len(batch) < self.batchSize:
+                remaining = deadline - time.time()
+                try:
+                    if remaining > 0:
+                        request = self.requests.get(timeout=remaining)
+                    else:
+                        request = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                batch.append(request)
+
+            self.runBatch(batch)
+
+            if stop:
+                return
+
+    # Run the model once for a batch of requests and give each its probabilities
+    def runBatch(self, batch):
+
+        import numpy as np
+
+        try:
+            boards = np.array([board for board, moves, future in batch])
+            size = boards.shape[1]
+            predictions = self.outputFunc([boards.reshape(len(batch), 1, size, size, size)])[0]
+        except Exception as exception:
+            for board, moves, future in batch:
+                future.set_exception(exception)
+            return
+
+        for i in range(len(batch)):
+            board, moves, future = batch[i]
+            prediction = predictions[i][0]
+            future.set_result([prediction[x][y][z] for x, y, z in moves])
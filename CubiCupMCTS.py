@@ -1,19 +1,59 @@
 import CubiCupState
 import CubiCupNode
+import CubiCupNodePool
+import CubiCupSolver
 import random
+import threading
 import time
 from CubiCupDriver import BLUE
 from CubiCupDriver import GREEN
+from CubiCupDriver import composePermutations
+from CubiCupDriver import invertPermutation
+from CubiCupDriver import permuteMove
 
 
 class MCTS:
 
-    def __init__(self, size, moveProbFunc=None):
+    # rolloutGames is how many random games each simulation plays, when more than one they are
+    # played at once by the NumPy batch rollout engine and their end values averaged.
+    # workers > 1 searches the one tree in parallel, with threads, or with processes playing the
+    # simulations if useProcesses is set. Simulations in progress add virtualLoss to their nodes.
+    # statelessNodes keeps only the moves in the tree, rebuilding positions on the way down, so
+    # the tree takes much less memory on big boards. With transpositions, nodes are shared by every
+    # move order reaching the same position, by Zobrist hash, so the tree becomes a DAG. With symmetry,
+    # moves leading to the same position turned some way are only searched once. With maxNodes, the
+    # tree is kept to that many nodes by pruning its least searched subtrees whenever it fills up. With
+    # endgameCells, positions with at most that many cube spots left empty are solved exactly instead of
+    # simulated, so the end of the game is played perfectly. Positions in tablebase (a CubiCupTablebase of
+    # this size) are proven straight from it. Roots in book (a CubiCupBook) start with the book's statistics.
+    def __init__(self, size, moveProbFunc=None, rolloutGames=1, workers=1, useProcesses=False, virtualLoss=1,
+                 statelessNodes=False, transpositions=False, symmetry=False, maxNodes=None, endgameCells=None,
+                 tablebase=None, book=None):
+        if statelessNodes:
+            self.nodeClass = CubiCupNode.StatelessNode
+        else:
+            self.nodeClass = CubiCupNode.Node
+        self.symmetry = symmetry
         newGameState = CubiCupState.State(size)
-        self.root = CubiCupNode.Node(None, newGameState, moveProbFunc=moveProbFunc)
+        self.root = self.nodeClass(None, newGameState, moveProbFunc=moveProbFunc, mergeSymmetric=symmetry)
         self.root.sims = 1  # First node needs to start at 1, otherwise sum of child sims is parent sims-1, no idea why, this is just a hacky fix
+        self.scratch = CubiCupState.State(size, newGameState)  # Walked down the tree with make/unmake
+        self.rolloutState = CubiCupState.State(size, newGameState)  # Reused by every simulation
         self.newRoot = None
+        self.newRootIndex = None
         self.newRootReady = False
+
+        # Controllers change the flags below through methods that notify this, and the search waits on it
+        # instead of polling when it has nothing to do. Controllers can wait on it too, see the waitFor methods
+        self.control = threading.Condition()
+        self.simulationTarget = None  # Root simulations to reach before telling controllers, see setSimulationTarget
+        self.simulationTargetCallback = None
+        self.simulationTargetReached = False
+
+        # Permutation turning the game's moves into the tree's. When the move played was only searched as a
+        # symmetric move, the tree carries on from that move's node, turned from the game that way
+        self.orientation = (0, 1, 2)
+        self.newOrientation = self.orientation
         self.reset = False
         self.gameSize = size
         self.simsSinceLastMove = 0
@@ -21,48 +61,244 @@ class MCTS:
         self.pause = False
         self.isPaused = False
         self.moveProbFunc = moveProbFunc
+        self.rolloutGames = rolloutGames
+        self.rolloutRng = None
+        self.workers = workers
+        self.useProcesses = useProcesses
+        self.virtualLoss = virtualLoss if workers > 1 else 0
+        self.lockNodes = workers > 1 and not useProcesses  # Only worker threads share nodes
+
+        # Node of each position hash in the tree, or None when positions aren't shared
+        if transpositions:
+            self.transpositions = {}
+            self.addRootTransposition()
+        else:
+            self.transpositions = None
+        self.transpositionLock = threading.Lock()
+
+        # Nodes dropped from the tree are kept in the pool for new ones, and the number of nodes in the tree
+        # is counted to keep it under maxNodes. Worker threads count under nodeCountLock
+        self.maxNodes = maxNodes
+        self.numNodes = 1
+        self.nodeCountLock = threading.Lock()
+        if maxNodes is not None:
+            self.pool = CubiCupNodePool.NodePool(maxNodes)
+        else:
+            self.pool = CubiCupNodePool.NodePool()
+
+        # Solver for endgame positions, its table of solved positions is kept for the whole game
+        self.endgameCells = endgameCells
+        if endgameCells is not None:
+            self.endgameSolver = CubiCupSolver.EndgameSolver()
+        else:
+            self.endgameSolver = None
+        self.tablebase = tablebase
+
+        if rolloutGames > 1:
+            # Only import NumPy when it's actually used
+            import numpy as np
+            self.rolloutRng = np.random.default_rng()
+
+        self.book = book
+        self.addBookToRoot()
 
     def resetMCTS(self):
         # Reset all parameters
         newGameState = CubiCupState.State(self.gameSize)
-        self.root = CubiCupNode.Node(None, newGameState, self.moveProbFunc)
+        self.root = self.nodeClass(None, newGameState, moveProbFunc=self.moveProbFunc, mergeSymmetric=self.symmetry)
+        self.root.sims = 1
+        self.scratch = CubiCupState.State(self.gameSize, newGameState)
+        self.rolloutState = CubiCupState.State(self.gameSize, newGameState)
         self.newRoot = None
         self.newRootReady = False
+        self.orientation = (0, 1, 2)
+        self.newOrientation = self.orientation
         self.reset = False
         self.simsSinceLastMove = 0
         self.pause = False
         self.kill = False
         self.isPaused = False
+        self.numNodes = 1
+        if self.transpositions is not None:
+            self.transpositions = {}
+            self.addRootTransposition()
+        if self.endgameSolver is not None:
+            # The game size can change, and positions of different sizes can have the same hash
+            self.endgameSolver = CubiCupSolver.EndgameSolver()
+        self.addBookToRoot()
 
     def indicateReset(self, size):
         # Indicate that we are ready to reset the MCTS
-        self.gameSize = size
-        self.reset = True
+        with self.control:
+            self.gameSize = size
+            self.reset = True
+            self.control.notify_all()
 
     def end(self):
-        self.kill = True
+        with self.control:
+            self.kill = True
+            self.control.notify_all()
 
     def setPause(self):
-        self.pause = True
+        with self.control:
+            self.pause = True
+            self.control.notify_all()
 
     def setPlay(self):
-        self.pause = False
+        with self.control:
+            self.pause = False
+            self.control.notify_all()
+
+    # Have the search tell controllers once the root has at least sims simulations, or can't be searched any
+    # further. callback (if given) is called then, from the search thread, or from this one if that's already
+    # the case, so it shouldn't wait on the search itself. waitForSimulationTarget waits for it
+    def setSimulationTarget(self, sims, callback=None):
+        with self.control:
+            self.simulationTarget = sims
+            self.simulationTargetCallback = callback
+            self.simulationTargetReached = False
+        self.checkSimulationTarget()
+
+    # Called by the search after simulations, to see if the simulation target has been reached
+    def checkSimulationTarget(self):
+
+        with self.control:
+            if self.simulationTarget is None:
+                return
+            if self.root.sims < self.simulationTarget and self.rootNeedsSearch():
+                return
+            callback = self.simulationTargetCallback
+            self.simulationTarget = None
+            self.simulationTargetCallback = None
+            self.simulationTargetReached = True
+            self.control.notify_all()
+
+        if callback is not None:
+            callback()
+
+    # Wait until the simulation target is reached or the search is ended. Returns whether it was reached,
+    # False if timeout (in seconds) ran out first
+    def waitForSimulationTarget(self, timeout=None):
+        with self.control:
+            return self.control.wait_for(lambda: self.simulationTargetReached or self.kill, timeout) \
+                and self.simulationTargetReached
+
+    # Wait until the search has paused after setPause
+    def waitForPause(self, timeout=None):
+        with self.control:
+            return self.control.wait_for(lambda: self.isPaused or self.kill, timeout)
+
+    # Wait until the search has moved to the new root after updateWithTurn, or reset after indicateReset
+    def waitForRootUpdate(self, timeout=None):
+        with self.control:
+            return self.control.wait_for(lambda: not (self.newRootReady or self.reset) or self.kill, timeout)
+
+    # Wait until the search's root is something other than root
+    def waitForNewRoot(self, root, timeout=None):
+        with self.control:
+            return self.control.wait_for(lambda: self.root is not root or self.kill, timeout)
 
     def updateWithTurn(self, move):
 
+        with self.control:
+            # New roots are found from the current one, so a move right after another waits for the search
+            # to have moved to the last one
+            self.control.wait_for(lambda: not self.newRootReady or self.kill)
+            self.findNewRoot(move)
+            self.control.notify_all()
+
+    # Set the new root to the child reached by move
+    def findNewRoot(self, move):
+
+        move = self.toTreeMove(move)
+        orientation = self.orientation
+
         # Find node with move in children list, then set the new root to that child
+        moves = self.root.getMoves()
+        symmetricTo = self.root.symmetricTo
         for i in range(len(self.root.children)):
-            child = self.root.children[i]
-            if child is not None:
-                if child.state.lastMove == move:
-                    self.newRoot = self.root.children[i]
-                    self.newRootReady = True
-                    self.simsSinceLastMove = 0
+            if moves[i] == move and symmetricTo is not None and symmetricTo[i] != i:
+                # Only the symmetric move was searched, carry on from it with the tree turned to match
+                searched = symmetricTo[i]
+                for permutation in self.root.state.getSymmetries():
+                    if permuteMove(move, permutation) == moves[searched]:
+                        orientation = composePermutations(self.orientation, permutation)
+                        move = moves[searched]
+                        break
+                break
+
+        # A move the search never tried doesn't have a node yet, updateRoot makes it (as newRoot is None)
+        for i in range(len(self.root.children)):
+            if moves[i] == move:
+                self.newRoot = self.root.children[i]
+                self.newRootIndex = i
+                self.newOrientation = orientation
+                self.newRootReady = True
+                self.simsSinceLastMove = 0
+
+    # Turn a move in the game into the same move in the tree
+    def toTreeMove(self, move):
+        return permuteMove(move, self.orientation)
+
+    # Turn a move in the tree, like root.getChildMove(), into the same move in the game
+    def toGameMove(self, move):
+        return permuteMove(move, invertPermutation(self.orientation))
+
+    # Get the root's simulations of each of its moves, as (move in the game's orientation, simulations) pairs for
+    # the moves searched. Moves only searched as a symmetric move share its simulations, like in
+    # getMoveProbabilities
+    def getRootVisits(self):
+
+        root = self.root
+        moves = root.getMoves()
+        if root.symmetricTo is not None:
+            searchedFor = root.symmetricTo
+        else:
+            searchedFor = range(len(root.children))
+        shares = [0 for i in range(len(root.children))]
+        for i in range(len(root.children)):
+            shares[searchedFor[i]] += 1
+
+        visits = []
+        for i in range(len(root.children)):
+            child = root.children[searchedFor[i]]
+            if child is not None and child.sims > 0:
+                visits.append((self.toGameMove(moves[i]), child.sims / shares[searchedFor[i]]))
+
+        return visits
+
+    # Turn root.getMoveProbabilities() into the game's orientation
+    def toGameMoveProbs(self, moveProbs):
+
+        if self.orientation == (0, 1, 2):
+            return moveProbs
+
+        size = len(moveProbs)
+        gameMoveProbs = [[[0 for x in range(size)] for y in range(size)] for z in range(size)]
+        for x in range(size):
+            for y in range(size):
+                for z in range(size):
+                    treeX, treeY, treeZ = self.toTreeMove((x, y, z))
+                    gameMoveProbs[x][y][z] = moveProbs[treeX][treeY][treeZ]
+
+        return gameMoveProbs
+
+    # Walk down from node to the most promising node to expand, following along on scratch (the search's
+    # scratch state if not given) and adding virtual loss to every node entered. If path is given, every
+    # node walked through is appended to it, node first, for backPropagate to follow back up
+    def selectNodeToExpand(self, node, scratch=None, path=None):
 
-    def selectNodeToExpand(self, node):
+        if scratch is None:
+            scratch = self.scratch
 
-        # If node is a game over, return it
+        if path is not None:
+            path.append(node)
+
+        # If node is a game over or proven, return it. With transpositions it can be a node another move order
+        # proved, that this one hasn't heard of yet
         if node.isTerminal:
+            if self.transpositions is not None and len(path) > 1:
+                self.propagateBounds(node, path)
             return node
 
         """
@@ -90,86 +326,520 @@ class MCTS:
                     bestNode = child
         """
 
-        expandIndex = node.getChildToExpandIndex()
+        if self.lockNodes:
+            lock = CubiCupNode.getLock(node)
+            lock.acquire()
 
-        # If child to expand is new, return it
-        if node.children[expandIndex] is None:
-            node.createChildAt(expandIndex)
-            return node.children[expandIndex]
+        expandIndex = node.getChildToExpandIndex(scratch)
 
-        return self.selectNodeToExpand(node.children[expandIndex])
+        # Follow the move on the scratch state, so it is always at the node being looked at. Scratch was
+        # walked to node the same way node's moves were made, so it has them in the same order, unless
+        # node is shared by several move orders
+        if self.transpositions is None:
+            scratch.makeMove(scratch.availableMoves[expandIndex])
+        else:
+            scratch.makeMove(node.moves[expandIndex])
 
-    def simulate(self, node):
+        # If child to expand is new, create it and return it. With transpositions, another move order
+        # may have reached its position already, then that node is shared instead and searched below
+        child = node.children[expandIndex]
+        if child is None:
+            if self.transpositions is None:
+                node.createChildAt(expandIndex, scratch, self.virtualLoss, self.pool)
+                if self.lockNodes:
+                    with self.nodeCountLock:
+                        self.numNodes += 1
+                else:
+                    self.numNodes += 1
+                created = True
+            else:
+                created = self.createOrLinkChildAt(node, expandIndex, scratch)
 
-        # Copy the state so that we have one we can update without changing anything we need
-        state = CubiCupState.State(self.gameSize, node.state)
+            child = node.children[expandIndex]
+            if created:
+                if self.lockNodes:
+                    lock.release()
+                if path is not None:
+                    path.append(child)
+                if child.isTerminal:
+                    # A game over, which bounds the nodes above it
+                    self.propagateBounds(child, path)
+                else:
+                    self.solveNode(child, scratch, path)
+                return child
 
-        # Loop until game is over, choosing random move each time
-        while not state.gameOver:
-            randomMove = state.availableMoves[random.randint(0, len(state.availableMoves) - 1)]
-            state.takeTurn(randomMove)
+        if self.lockNodes:
+            lock.release()
+            with CubiCupNode.getLock(child):
+                child.virtualLoss += self.virtualLoss
+        else:
+            child.virtualLoss += self.virtualLoss
 
-        return state.endValue
+        return self.selectNodeToExpand(child, scratch, path)
 
-    def backPropagate(self, endValue, node):
+    # Prove a new node if its value is known without searching it, from the tablebase or the endgame solver,
+    # given scratch at its position, and pass that up like a game over. Other workers may have already
+    # searched below it, so the change its bounds made is what's passed up
+    def solveNode(self, node, scratch, path=None):
 
-        # Traverse tree by calling parents, incremented simulations and score
-        while node is not self.root:
+        endValue = self.getSolvedValue(scratch)
+        if endValue is None:
+            return
+
+        if self.lockNodes:
+            with CubiCupNode.getLock(node):
+                change = node.setSolved(endValue)
+        else:
+            change = node.setSolved(endValue)
+
+        if change is not None:
+            self.propagateBounds(node, path, change)
+
+    # Get the end value of state's game with best play, if the tablebase has it or it's an endgame, otherwise None
+    def getSolvedValue(self, state):
+
+        if self.tablebase is not None:
+            solved = self.tablebase.probe(state)
+            if solved is not None:
+                return solved[0]
+
+        if self.endgameSolver is not None and CubiCupSolver.isEndgame(state, self.endgameCells):
+            return self.endgameSolver.solve(state)[0]
+
+        return None
 
-            if node.isTerminal:
-                # If this node is terminal, check to see if the parent is as well
-                node.parent.checkForTerminal()
+    # Pass the bounds of node, which was just made or found proven, up to the nodes above it for as long as
+    # they change, which proves those above it that it decides (MCTS-solver). Each change is passed up by the
+    # worker that made it, so a parent only needs to take in the difference. With transpositions, changes
+    # don't reach every parent a node has, so each node on path works its bounds out from its children again.
+    # change is how node's bounds changed, as updateBounds returns it, if node isn't new
+    def propagateBounds(self, node, path=None, change=None):
+
+        if self.transpositions is not None:
+            for i in range(len(path) - 2, -1, -1):
+                parent = path[i]
+                if self.lockNodes:
+                    with CubiCupNode.getLock(parent):
+                        change = parent.recomputeBounds()
+                else:
+                    change = parent.recomputeBounds()
+                if change is None:
+                    return
+            return
+
+        if change is None:
+            # A new node only had its parent's default bounds before
+            change = (0, node.lowerBound, 1, node.upperBound)
+        while change is not None and node.parent is not None:
+            parent = node.parent
+            if self.lockNodes:
+                with CubiCupNode.getLock(parent):
+                    change = parent.updateBounds(node, *change)
+            else:
+                change = parent.updateBounds(node, *change)
+            node = parent
+
+    # Make the ith child of node the node already in the tree for scratch's position, or create it and add
+    # it to the table if there isn't one. Returns whether it was created
+    def createOrLinkChildAt(self, node, i, scratch):
+
+        with self.transpositionLock:
+            child = self.transpositions.get(scratch.hash)
+            if child is not None:
+                node.linkChildAt(i, child)
+                return False
+
+            node.createChildAt(i, scratch, self.virtualLoss, self.pool)
+            self.numNodes += 1  # Nodes are only created here with transpositions, under its lock
+            child = node.children[i]
+            if child.moves is None:
+                # Stateless nodes need their own moves, see StatelessNode
+                child.moves = tuple(scratch.availableMoves)
+            self.transpositions[scratch.hash] = child
+            return True
+
+    def addRootTransposition(self):
+        if self.root.moves is None:
+            self.root.moves = tuple(self.root.state.availableMoves)
+        self.transpositions[self.root.hash] = self.root
+
+    # After the root has moved, drop every node that can't be reached from it anymore. Shared nodes that were
+    # created under a parent that is being dropped are moved under one that's kept, so nothing still refers
+    # to the dropped nodes
+    def pruneTranspositions(self):
+
+        self.transpositions = {}
+        self.addRootTransposition()
+
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            for i in range(len(node.children)):
+                child = node.children[i]
+                if child is not None and child.hash not in self.transpositions:
+                    child.parent = node
+                    child.move = node.moves[i]
+                    self.transpositions[child.hash] = child
+                    stack.append(child)
+
+    # Get a list for selectNodeToExpand to record its path in, only needed when nodes can have several parents
+    def newPath(self):
+        if self.transpositions is None:
+            return None
+        return []
+
+    # Put a scratch state walked down the tree back at the root
+    def unwind(self, scratch):
+        while scratch.journal:
+            scratch.unmakeMove()
+
+    # Simulate a game from node, which scratch (the search's scratch state if not given) was walked down
+    # to while selecting it. Afterwards scratch is back at the root
+    def simulate(self, node, scratch=None, rolloutState=None):
+
+        if scratch is None:
+            scratch = self.scratch
+            rolloutState = self.rolloutState
+
+        knownValue = self.getKnownValue(node)
+        if knownValue is not None:
+            # Game over or proven, the value is already known
+            self.unwind(scratch)
+            return knownValue
+
+        if self.rolloutGames > 1:
+            # Play all the games at once from the scratch state, then put it back at the root
+            endValue = playout(scratch, self.rolloutGames, self.rolloutRng)
+            self.unwind(scratch)
+            return endValue
+
+        # Undoing every random move one by one costs more than one copy, so play them on the
+        # reused rollout state instead
+        rolloutState.copyFrom(scratch)
+        self.unwind(scratch)
+
+        return playout(rolloutState)
+
+    # The value of node if it is already known, because its game is over or it has been proven, otherwise None
+    def getKnownValue(self, node):
+        return node.terminalValue if node.isTerminal else None
+
+    # Traverse tree by calling parents, incremented simulations and score, and taking back the
+    # virtual loss that was added on the way down. With transpositions a node has more than one parent,
+    # so the path selectNodeToExpand took is followed back up instead
+    def backPropagate(self, endValue, node, virtualLoss=0, path=None):
+
+        if self.lockNodes:
+            self.backPropagateLocked(endValue, node, virtualLoss, path)
+            return
+
+        if path is not None:
+            for i in range(len(path) - 1, -1, -1):
+                node = path[i]
+                node.updateWith(1, endValue)
+                node.virtualLoss -= virtualLoss
+            return
+
+        while node is not self.root:
 
             node.updateWith(1, endValue)
+            node.virtualLoss -= virtualLoss
             node = node.parent
 
         # Update root values to finish
         self.root.updateWith(1, endValue)
+        self.root.virtualLoss -= virtualLoss
 
-    def run(self):
+    # Same as backPropagate, holding each node's lock while updating it, for worker threads
+    def backPropagateLocked(self, endValue, node, virtualLoss, path=None):
 
-        while True:
+        if path is not None:
+            for i in range(len(path) - 1, -1, -1):
+                node = path[i]
+                with CubiCupNode.getLock(node):
+                    node.updateWith(1, endValue)
+                    node.virtualLoss -= virtualLoss
+            return
+
+        while node is not self.root:
+
+            with CubiCupNode.getLock(node):
+                node.updateWith(1, endValue)
+                node.virtualLoss -= virtualLoss
+
+            node = node.parent
+
+        with CubiCupNode.getLock(self.root):
+            self.root.updateWith(1, endValue)
+            self.root.virtualLoss -= virtualLoss
+
+    # Whether the root still needs searching, we run for a max of a million simulations, or until the
+    # root node is determined to be terminal
+    def rootNeedsSearch(self):
+        return not self.root.isTerminal and self.root.sims < 1000000
+
+    # Handle a new root or a reset, only done while no simulations are in progress
+    def updateRoot(self):
+
+        if not (self.newRootReady or self.reset or self.treeFull()):
+            return
+
+        with self.control:
 
             # If move is made, we want to update the root node
             if self.newRootReady:
+                if self.newRoot is None:
+                    self.newRoot = self.createRootChild(self.newRootIndex)
+                oldRoot = self.root
                 self.root = self.newRoot    # Change root node
-                self.root.parent = None     # Delete parent, since it is now irrelevant, this saves memory
+                self.root.makeRoot()        # Delete parent, since it is now irrelevant, this saves memory
+                if self.root.childrenUnexplored == len(self.root.children):
+                    # Nothing below to show for its simulations (they're from the opening book, or its children
+                    # were pruned), start it like a new root so they don't count towards searching it
+                    self.root.sims = 1
+                    self.root.score = 0
+                if self.root.isTerminal and self.root.getBestChild() is None and not self.root.state.gameOver:
+                    # Solved by the tablebase or endgame solver without its moves being searched, search them so
+                    # there's a move to play, each one is solved straight away
+                    self.root.clearBounds()
+                    self.root.recomputeBounds()
+                self.orientation = self.newOrientation
+                self.scratch = CubiCupState.State(self.gameSize, self.root.state)
                 self.newRootReady = False
+                if self.transpositions is not None:
+                    self.pruneTranspositions()
+
+                # The old root and the other moves' subtrees go back to the pool
+                self.numNodes -= self.releaseNodes([oldRoot])
+
+                self.addBookToRoot()
 
             # If reset has been indicated, for something like the start of a new game, do a reset
             if self.reset:
+                oldRoot = self.root
                 self.resetMCTS()
+                self.releaseNodes([oldRoot])
 
-            if self.kill:
+            if self.treeFull():
+                self.pruneTree()
+
+            self.control.notify_all()
+
+    # Start the root's children off with the opening book's statistics for them, when the book has searched the
+    # root's position more than the tree has. Children are made for book moves the tree doesn't have yet
+    def addBookToRoot(self):
+
+        if self.book is None:
+            return
+
+        entry = self.book.probe(self.root.state)
+        if entry is None or sum(sims for move, sims, score in entry) <= self.root.sims:
+            return
+
+        if self.root.childProbs is None and self.moveProbFunc is not None:
+            # Children made now get their probabilities from the network, like they would in the search
+            self.root.setChildProbs(self.root.state)
+
+        moves = self.root.getMoves()
+        symmetricTo = self.root.symmetricTo
+        for move, sims, score in entry:
+            i = moves.index(move)
+            if symmetricTo is not None:
+                # Only the symmetric move is searched, it gets the statistics of every move it stands for
+                i = symmetricTo[i]
+
+            child = self.root.children[i]
+            if child is None:
+                child = self.createRootChild(i)
+
+            # End values of the two players add up to 1, the root's player scores what the child's doesn't
+            child.sims += sims
+            child.score += score
+            self.root.sims += sims
+            self.root.score += sims - score
+
+    # Whether the tree has reached maxNodes and needs pruning
+    def treeFull(self):
+        return self.maxNodes is not None and self.numNodes >= self.maxNodes
+
+    # Cut the least searched subtrees out of the tree until it's down to three quarters of maxNodes, giving
+    # the search room to grow again before the next time. The root's children are never cut, so the root's
+    # move probabilities stay whole, and neither are nodes with proven bounds, which their parents count on.
+    # A node's simulations are about the size of its subtree, so those are what's cut until enough is. Cut
+    # nodes' statistics are still in their parents, they're only searched again from scratch if reached
+    def pruneTree(self):
+
+        # Every node below the root's children, with the parent it's under. With transpositions only
+        # the parent a node was created under is used, nodes linked from elsewhere are found through that one
+        candidates = []
+        stack = [child for child in self.root.children if child is not None and child.parent is self.root]
+        while stack:
+            node = stack.pop()
+            for i in range(len(node.children)):
+                child = node.children[i]
+                if child is not None and child.parent is node:
+                    if child.lowerBound == 0 and child.upperBound == 1:
+                        candidates.append((child.sims, node, i))
+                    stack.append(child)
+
+        candidates.sort(key=lambda candidate: candidate[0])
+
+        toCut = self.numNodes - self.maxNodes * 3 // 4
+        cut = []
+        for sims, parent, i in candidates:
+            if toCut <= 0:
                 break
+            cut.append(parent.children[i])
+            parent.children[i] = None
+            parent.childrenUnexplored += 1
+            toCut -= max(sims, 1)
 
-            if self.pause:
-                self.isPaused = True
-            else:
+        if self.transpositions is not None:
+            # Cut nodes can still be linked from other parents, those are kept
+            self.pruneTranspositions()
 
-                # Run for a max of a million simulations, or until the root node is determined to be terminal
-                if not self.root.isTerminal and self.root.sims < 1000000:
+        self.numNodes -= self.releaseNodes(cut)
 
-                    self.simsSinceLastMove = self.simsSinceLastMove + 1
+    # Release every node below (and including) roots that is no longer in the tree to the pool, returning
+    # how many were released
+    def releaseNodes(self, roots):
 
-                    # Select most promising node to expand upon
-                    nodeToExpand = self.selectNodeToExpand(self.root)
+        released = set()
+        stack = list(roots)
+        while stack:
+            node = stack.pop()
+            if id(node) in released or node is self.root:
+                continue
+            if self.transpositions is not None and self.transpositions.get(node.hash) is node:
+                # Still reached from the root by another move order
+                continue
+            released.add(id(node))
+            for child in node.children:
+                if child is not None:
+                    stack.append(child)
+            self.pool.release(node)
 
-                    # Using the most promising node as determined by the MCTS algorithm, determine
-                    # the value and policy heads as predicted by the neural network.
-                    # This should update the probabilities, telling us which move to explore, then
-                    # we should back propagate the value during that step
-                    # call neuralNet( bestNode )
+        return len(released)
 
-                    # Simulate game starting from that node, recording who won
-                    endValue = self.simulate(nodeToExpand)
+    # Make the root's ith child, for a move played that the search hadn't reached
+    def createRootChild(self, i):
 
-                    # Back propagate the result of that simulation through the tree
-                    self.backPropagate(endValue, nodeToExpand)
+        if self.transpositions is not None:
+            self.scratch.makeMove(self.root.getMoves()[i])
+            self.createOrLinkChildAt(self.root, i, self.scratch)
+            self.scratch.unmakeMove()
+        else:
+            self.root.createChildAt(i, pool=self.pool)
+            self.numNodes += 1
 
-                else:
-                    # No more searching being done, just sleep to be courteous to cpu
-                    time.sleep(0.1)
+        return self.root.children[i]
+
+    # Whether the search has something to do right now
+    def searchNeeded(self):
+        return self.kill or self.reset or self.newRootReady or (not self.pause and self.rootNeedsSearch())
+
+    # Wait, without using the cpu, until a controller gives the search something to do. Whether it's
+    # paused is set for controllers waiting on that
+    def waitUntilNeeded(self):
+
+        with self.control:
+            while True:
+                if self.isPaused != self.pause:
+                    self.isPaused = self.pause
+                    self.control.notify_all()
+                if self.searchNeeded():
+                    break
+                self.control.wait()
+
+    # Play one simulation from the root in this thread
+    def runSimulation(self):
+
+        self.simsSinceLastMove = self.simsSinceLastMove + 1
+
+        # Workers' virtual loss is kept consistent, so the tree can be searched either way
+        if self.virtualLoss:
+            self.root.virtualLoss += self.virtualLoss
+
+        # Select most promising node to expand upon
+        path = self.newPath()
+        nodeToExpand = self.selectNodeToExpand(self.root, path=path)
+
+        # Using the most promising node as determined by the MCTS algorithm, determine
+        # the value and policy heads as predicted by the neural network.
+        # This should update the probabilities, telling us which move to explore, then
+        # we should back propagate the value during that step
+        # call neuralNet( bestNode )
+
+        # Simulate game starting from that node, recording who won
+        endValue = self.simulate(nodeToExpand)
+
+        # Back propagate the result of that simulation through the tree
+        self.backPropagate(endValue, nodeToExpand, self.virtualLoss, path)
+
+    # Search from the root in the caller's thread, without run(), until the root has simulations simulations
+    # (counting ones kept from earlier moves, like setSimulationTarget) or timeMs milliseconds have passed,
+    # whichever comes first. With untilProven it also stops once the root is proven, and either way it stops
+    # where run() would stop searching a root that isn't proven. Returns the best move (in the game's orientation, None if the game is over), its
+    # score, the root's simulations and the root's move probabilities, as getMoveProbabilities gives them.
+    # Don't use this while run() is searching the same tree
+    def search(self, simulations=None, timeMs=None, untilProven=True):
+
+        if timeMs is not None:
+            endTime = time.time() + timeMs / 1000
+
+        while not self.root.state.gameOver and self.root.sims < 1000000:
+
+            if untilProven and self.root.isTerminal:
+                break
+            if simulations is not None and self.root.sims >= simulations:
+                break
+            if timeMs is not None and time.time() >= endTime:
+                break
+
+            self.runSimulation()
+
+            if self.treeFull():
+                self.pruneTree()
+
+        bestChild = self.root.getBestChild()
+        if bestChild is None:
+            return None, None, self.root.sims, self.toGameMoveProbs(self.root.getMoveProbabilities())
+
+        bestMove = self.toGameMove(self.root.getChildMove(bestChild))
+        return bestMove, bestChild.getScore(), self.root.sims, self.toGameMoveProbs(self.root.getMoveProbabilities())
+
+    # Move the root on by a move played in the game, in the caller's thread, to go with search()
+    def advance(self, move):
+        self.updateWithTurn(move)
+        self.updateRoot()
+
+    def run(self):
+
+        if self.workers > 1:
+            if self.useProcesses:
+                self.runProcessWorkers()
+            else:
+                self.runThreadWorkers()
+            return
+
+        while True:
+
+            self.updateRoot()
+
+            if self.kill:
+                break
+
+            if self.pause or not self.rootNeedsSearch():
+                # Paused, or no more searching to be done, wait until that changes
+                self.checkSimulationTarget()
+                self.waitUntilNeeded()
+            else:
+
+                self.isPaused = False
+                self.runSimulation()
+
+                if self.simulationTarget is not None:
+                    self.checkSimulationTarget()
 
 
 
@@ -177,6 +847,153 @@ class MCTS:
             #self.printNodeChildren(self.root, "")
             #print("")
 
+    # Search with self.workers threads sharing the tree. This thread handles pausing, new roots and resets,
+    # which wait until no worker is in the middle of a simulation
+    def runThreadWorkers(self):
+
+        self.activeWorkers = 0
+        self.holdWorkers = False
+
+        threads = []
+        for i in range(self.workers):
+            threads.append(threading.Thread(target=self.workerLoop))
+            threads[i].daemon = True
+            threads[i].start()
+
+        with self.control:
+            while True:
+
+                if self.newRootReady or self.reset or self.kill or self.pause or self.treeFull():
+                    # Stop workers from starting simulations, and wait for the ones in progress
+                    self.holdWorkers = True
+                    while self.activeWorkers > 0:
+                        self.control.wait()
+
+                    self.updateRoot()
+
+                    if self.kill:
+                        self.control.notify_all()
+                        break
+
+                    self.isPaused = self.pause
+                    self.control.notify_all()
+
+                if self.holdWorkers and not self.pause:
+                    self.holdWorkers = False
+                    self.isPaused = False
+                    self.control.notify_all()
+
+                # Sleep until a controller or a worker changes something
+                self.control.wait()
+
+        for thread in threads:
+            thread.join()
+
+    # Run simulations in a worker thread, each worker has its own scratch and rollout states
+    def workerLoop(self):
+
+        root = None
+        scratch = None
+        rolloutState = None
+
+        while True:
+
+            with self.control:
+                while not self.kill and (self.holdWorkers or not self.rootNeedsSearch()):
+                    self.control.wait()
+
+                if self.kill:
+                    return
+
+                self.activeWorkers += 1
+
+                # Root has changed since the last simulation, start from the new one
+                if root is not self.root:
+                    root = self.root
+                    scratch = CubiCupState.State(self.gameSize, root.state)
+                    rolloutState = CubiCupState.State(self.gameSize, root.state)
+
+            try:
+                self.simsSinceLastMove = self.simsSinceLastMove + 1
+
+                with CubiCupNode.getLock(root):
+                    root.virtualLoss += self.virtualLoss
+
+                path = self.newPath()
+                nodeToExpand = self.selectNodeToExpand(root, scratch, path)
+                endValue = self.simulate(nodeToExpand, scratch, rolloutState)
+                self.backPropagate(endValue, nodeToExpand, self.virtualLoss, path)
+            finally:
+                with self.control:
+                    self.activeWorkers -= 1
+                    self.control.notify_all()
+
+            if self.simulationTarget is not None:
+                self.checkSimulationTarget()
+
+    # Search with self.workers processes playing the simulations. The tree stays in this thread, which
+    # keeps several selected nodes waiting on simulations at once, virtual loss keeps them spread out
+    def runProcessWorkers(self):
+
+        import concurrent.futures
+
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, initializer=seedWorker)
+        inProgress = {}  # Simulation future -> node it was started from, and the path to it
+
+        while True:
+
+            if self.newRootReady or self.reset or self.kill or self.pause or self.treeFull():
+                # Finish simulations in progress before the tree changes
+                for future in concurrent.futures.as_completed(inProgress):
+                    nodeToExpand, path = inProgress[future]
+                    self.backPropagate(future.result(), nodeToExpand, self.virtualLoss, path)
+                inProgress.clear()
+
+                self.updateRoot()
+
+                if self.kill:
+                    break
+
+                if self.pause:
+                    self.waitUntilNeeded()
+                    continue
+
+            self.isPaused = False
+
+            # Keep every process busy, with one simulation waiting for each as well
+            while len(inProgress) < 2 * self.workers and self.rootNeedsSearch():
+
+                self.simsSinceLastMove = self.simsSinceLastMove + 1
+
+                self.root.virtualLoss += self.virtualLoss
+                path = self.newPath()
+                nodeToExpand = self.selectNodeToExpand(self.root, path=path)
+
+                if nodeToExpand.isTerminal:
+                    # Nothing to simulate, the game is already over or proven
+                    endValue = nodeToExpand.terminalValue
+                    self.unwind(self.scratch)
+                    self.backPropagate(endValue, nodeToExpand, self.virtualLoss, path)
+                else:
+                    state = CubiCupState.State(self.gameSize, self.scratch)
+                    self.unwind(self.scratch)
+                    inProgress[pool.submit(playout, state, self.rolloutGames)] = (nodeToExpand, path)
+
+            if inProgress:
+                done, notDone = concurrent.futures.wait(inProgress, timeout=0.1,
+                                                        return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    nodeToExpand, path = inProgress.pop(future)
+                    self.backPropagate(future.result(), nodeToExpand, self.virtualLoss, path)
+                if self.simulationTarget is not None:
+                    self.checkSimulationTarget()
+            else:
+                # No more searching to be done, wait until that changes
+                self.checkSimulationTarget()
+                self.waitUntilNeeded()
+
+        pool.shutdown(cancel_futures=True)
+
     # Debugging routine, used to print the tree, called recursively
     def printNodeChildren(self, node, header):
 
@@ -200,3 +1017,25 @@ class MCTS:
 
 
 
+
+
+# Play a game out randomly from state and return its end value. With more than one game, they are all
+# played at once by the NumPy batch rollout engine and the average end value is returned, otherwise
+# state itself is played on. Also used by worker processes, so it's a plain function
+def playout(state, games=1, rng=None):
+
+    if games > 1:
+        import CubiCupRollout
+        return CubiCupRollout.averageEndValue(state, games, rng)
+
+    # Loop until game is over, choosing random move each time
+    while not state.gameOver:
+        randomMove = state.availableMoves[random.randint(0, len(state.availableMoves) - 1)]
+        state.takeTurn(randomMove)
+
+    return state.endValue
+
+
+# Worker processes are forked with the same random state, give each its own
+def seedWorker():
+    random.seed()
@@ -0,0 +1,52 @@
+# A list of moves that can also find and remove a move in O(1). It's still a list, so len, indexing and
+# iteration work as before, but remove() moves the last move into the removed move's position instead
+# of shifting everything after it down, so the order of the moves changes.
+class MoveSet(list):
+
+    def __init__(self, moves=()):
+        list.__init__(self, moves)
+        if isinstance(moves, MoveSet):
+            self.positions = dict(moves.positions)
+        else:
+            self.positions = {move: i for i, move in enumerate(self)}
+
+    def __contains__(self, move):
+        return move in self.positions
+
+    # Add a move to the end
+    def append(self, move):
+        self.positions[move] = len(self)
+        list.append(self, move)
+
+    # Remove a move, putting the last move where it was
+    def remove(self, move):
+        position = self.positions.pop(move)
+        lastMove = list.pop(self)
+        if lastMove != move:
+            self[position] = lastMove
+            self.positions[lastMove] = position
+
+    # Undo remove(move), given the position move was removed from
+    def insertAt(self, move, position):
+        if position == len(self):
+            self.append(move)
+        else:
+            displaced = self[position]
+            self[position] = move
+            self.positions[move] = position
+            self.append(displaced)
+
+    # Remove the last move
+    def pop(self):
+        move = list.pop(self)
+        del self.positions[move]
+        return move
+
+    def index(self, move):
+        return self.positions[move]
+
+    # Make this set the same as another one, reusing this set's objects
+    def copyFrom(self, moveSet):
+        self[:] = moveSet
+        self.positions.clear()
+        self.positions.update(moveSet.positions)
@@ -1,19 +1,66 @@
 from math import sqrt
 from math import log
+import threading
 import CubiCupState
 import CubiCupNode
+import CubiCupNodePool
 from CubiCupDriver import BLUE
 from CubiCupDriver import GREEN
+from CubiCupDriver import permuteMove
 import Network
 
+# Locks guarding node statistics when several workers search one tree. Nodes share a fixed set of
+# locks by id rather than each holding one, so they cost no extra memory. Only ever hold one at a time,
+# a node and its parent can share a lock.
+nodeLocks = [threading.Lock() for i in range(1024)]
+
+
+def getLock(node):
+    return nodeLocks[(id(node) >> 4) % len(nodeLocks)]
+
+
+# For each available move of state, the index of the first move leading to the same position turned some way.
+# None if state has no symmetries, then no two moves do
+def getSymmetricMoves(state):
+
+    symmetries = state.getSymmetries()
+    if not symmetries:
+        return None
+
+    # The symmetries of a position are a group, so turning a move by each of them finds every move it's
+    # the same as
+    moves = state.availableMoves
+    symmetricTo = list(range(len(moves)))
+    for i in range(len(moves)):
+        for permutation in symmetries:
+            symmetricTo[i] = min(symmetricTo[i], moves.index(permuteMove(moves[i], permutation)))
+
+    return symmetricTo
+
+
+# The outcome of an end value for one player, 1 for a win, 0.5 for a tie and 0 for a loss. Players' outcomes
+# always add up to 1, like their end values do
+def getOutcome(value):
+    if value >= 1:
+        return 1
+    elif value <= 0:
+        return 0
+    else:
+        return 0.5
+
 
 class Node:
 
-    def __init__(self, parent, state, probability=1, moveProbFunc=None):
+    # With mergeSymmetric, moves that lead to the same position turned some way are only searched once
+    def __init__(self, parent, state, probability=1, moveProbFunc=None, mergeSymmetric=False):
         self.parent = parent
         self.state = state
+        self.move = state.lastMove  # Move that led to this node from parent
+        self.hash = state.hash
+        self.moves = state.availableMoves  # Moves in the same order as children
         self.score = 0
         self.sims = 0
+        self.virtualLoss = 0  # Simulations in progress below this node, counted as losses until they finish
         self.explore = 2
         self.terminalChild = None
         self.actionFor = state.lastTurn()
@@ -21,64 +68,217 @@ class Node:
         self.children = [None for x in range(len(state.availableMoves))]
         self.childrenUnexplored = len(self.children)
         self.moveProbFunc = moveProbFunc
+        self.mergeSymmetric = mergeSymmetric
 
-        if moveProbFunc is not None:
-            self.childProbs = Network.getMoveProbs(self.state, moveProbFunc)
+        # For each move, the index of the move searched in its place, or None if every move is searched
+        if mergeSymmetric:
+            self.symmetricTo = getSymmetricMoves(state)
         else:
-            self.childProbs = None
-
-        if self.state.gameOver:
+            self.symmetricTo = None
+
+        # Probabilities of the moves from the network. Most nodes are only ever simulated from, never
+        # expanded, so they're only worked out once the node is first expanded, see setChildProbs
+        self.childProbs = None
+
+        # Bounds on the outcome (see getOutcome) the player to move here is proven to get, and how many of
+        # the moves searched have children whose own lower bound is 0 or 0.5 (children not made yet count
+        # as 0). The player to move can't do better than the best of those, see updateBounds.
+        # The node is proven once they meet, then it's terminal, and the search no longer goes into it
+        if state.gameOver:
+            self.lowerBound = getOutcome(state.endValue[state.turn])
+            self.upperBound = self.lowerBound
+            self.openChildren = 0
+            self.drawnChildren = 0
             self.isTerminal = True
             self.terminalValue = state.endValue
-            self.terminalScore = state.endValue[self.state.turn]
+            self.terminalScore = self.lowerBound
         else:
-            self.isTerminal = False
-            self.terminalValue = None
-            self.terminalScore = -float("inf")
+            self.clearBounds()
+
+    # Set the bounds back to knowing nothing about the outcome, for a node with no children yet
+    def clearBounds(self):
+        self.lowerBound = 0
+        self.upperBound = 1
+        if self.symmetricTo is None:
+            self.openChildren = len(self.children)
+        else:
+            self.openChildren = sum(1 for i in range(len(self.children)) if self.symmetricTo[i] == i)
+        self.drawnChildren = 0
+        self.isTerminal = False
+        self.terminalValue = None
+        self.terminalScore = -float("inf")
+        self.terminalChild = None
 
-    # Create a child from the ith available move
-    def createChildAt(self, i):
-        # Copy current state
-        newChildState = CubiCupState.State(self.state.boardSize, self.state)
+    # Create a child from the ith available move. If a state that has already taken that move is
+    # given (like the search's scratch state), it's copied instead of redoing the move. The child starts
+    # with virtualLoss, so other workers see it as being searched as soon as it's in the tree. The child
+    # node is taken from pool if one is given
+    def createChildAt(self, i, stateAfterMove=None, virtualLoss=0, pool=None):
 
-        # Update the new state with the ith available move
-        newChildState.takeTurn(self.state.availableMoves[i])
+        if stateAfterMove is not None:
+            newChildState = CubiCupState.State(self.state.boardSize, stateAfterMove)
+        else:
+            # Copy current state
+            newChildState = CubiCupState.State(self.state.boardSize, self.state)
+
+            # Update the new state with the ith available move
+            newChildState.takeTurn(self.moves[i])
 
         # Create new node with new state, listing this node as parent
         if self.childProbs is None:
-            self.children[i] = CubiCupNode.Node(self, newChildState, moveProbFunc=self.moveProbFunc)
+            child = CubiCupNodePool.newNode(pool, CubiCupNode.Node, self, newChildState,
+                                            moveProbFunc=self.moveProbFunc, mergeSymmetric=self.mergeSymmetric)
         else:
-            self.children[i] = CubiCupNode.Node(self, newChildState, probability=self.childProbs[i], moveProbFunc=self.moveProbFunc)
+            child = CubiCupNodePool.newNode(pool, CubiCupNode.Node, self, newChildState,
+                                            probability=self.childProbs[i], moveProbFunc=self.moveProbFunc,
+                                            mergeSymmetric=self.mergeSymmetric)
+
+        child.virtualLoss = virtualLoss
+        self.children[i] = child
 
         # This node has a child, it is no longer a leaf
         self.childrenUnexplored -= 1
 
-    # Check to see if this node is terminal, terminal is defined by:
-    #   1) A child can result in a forced win for this node, terminal win
-    #   2) All children are terminal
-    # This attempts to find the best win available, but this doesn't guarantee we find the
-    # best win, we could get the greatest terminal score that is a win, but if a better move
-    # has not been determined to be terminal yet, we can't find it.
-    def checkForTerminal(self):
+    # Make an existing node the child from the ith available move, for when another move order already reached
+    # its position. The node keeps its own parent, that's the move order its move is from
+    def linkChildAt(self, i, child):
+        self.children[i] = child
+        self.childrenUnexplored -= 1
 
-        allChildrenTerminal = True  # Assume all nodes are terminal
+    # Get the move from this node to one of its children. With transpositions a child can be shared by
+    # several parents, so its own move is only right for its parent
+    def getChildMove(self, child):
+        return self.getMoves()[self.children.index(child)]
+
+    # Get the moves, in the same order as children
+    def getMoves(self):
+        return self.moves
+
+    # Make this node the root of the tree, dropping its parent since it is now irrelevant, this saves memory
+    def makeRoot(self):
+        self.parent = None
+
+    # Take a change in a child's bounds into this node's, without looking at the other children. The child's
+    # lower bound went from oldLower to lower and its upper bound from oldUpper to upper. Outcomes of the two
+    # players add up to 1, so a child the other player is proven at least a tie in holds this node's player
+    # to at most a tie, and the other way around. Returns the same four values for this node if its bounds
+    # changed, for its parent, otherwise None
+    def updateBounds(self, child, oldLower, lower, oldUpper, upper):
+
+        if lower != oldLower:
+            if oldLower == 0:
+                self.openChildren -= 1
+            elif oldLower == 0.5:
+                self.drawnChildren -= 1
+            if lower == 0.5:
+                self.drawnChildren += 1
+
+        return self.setBounds(child, 1 - upper)
+
+    # Work this node's bounds out from all of its children again, for when children can have several parents
+    # and so changes in them don't always come through this node. Returns the same as updateBounds
+    def recomputeBounds(self):
+
+        openChildren = 0
+        drawnChildren = 0
+        bestLower = 0
+        bestChild = None
+        for i in range(len(self.children)):
+            if self.symmetricTo is not None and self.symmetricTo[i] != i:
+                # Never searched, its symmetric move stands for it
+                continue
+            child = self.children[i]
+            if child is None or child.lowerBound == 0:
+                openChildren += 1
+            elif child.lowerBound == 0.5:
+                drawnChildren += 1
+            if child is not None and 1 - child.upperBound > bestLower:
+                bestLower = 1 - child.upperBound
+                bestChild = child
 
-        # Loop through all children
-        for child in self.children:
-            if child is not None and child.isTerminal:
-                # If child has better terminal value, save it
-                if child.terminalValue[child.actionFor] >= self.terminalScore:
-                    self.terminalChild = child
-                    self.terminalValue = child.terminalValue
-                    self.terminalScore = child.terminalValue[child.actionFor]
-            else:
-                # Non-existent child or non terminal child
-                allChildrenTerminal = False
+        # Bounds only ever get tighter, so a child counted as drawn or better before stays counted that way
+        openOrDrawn = min(openChildren + drawnChildren, self.openChildren + self.drawnChildren)
+        self.openChildren = min(openChildren, self.openChildren)
+        self.drawnChildren = openOrDrawn - self.openChildren
+
+        return self.setBounds(bestChild, bestLower)
+
+    # Set the lower bound to childLower if that's better, from child, and the upper bound from the counts of
+    # children. Marks the node terminal once they meet. Returns the same as updateBounds
+    def setBounds(self, child, childLower):
+
+        oldLower = self.lowerBound
+        oldUpper = self.upperBound
 
-        # All child nodes are terminal or we found a terminal win
-        if allChildrenTerminal or self.terminalScore >= 1:
+        if childLower > self.lowerBound:
+            self.lowerBound = childLower
+            self.terminalChild = child
+
+        if self.openChildren > 0:
+            upper = 1
+        elif self.drawnChildren > 0:
+            upper = 0.5
+        else:
+            upper = 0
+        self.upperBound = min(self.upperBound, max(upper, self.lowerBound))
+
+        if self.lowerBound >= self.upperBound and not self.isTerminal:
+            # Proven, the player to move here gets lowerBound with best play, and the other player the rest
+            self.terminalScore = self.lowerBound
+            self.terminalValue = self.getProvenValue()
             self.isTerminal = True
 
+        if self.lowerBound == oldLower and self.upperBound == oldUpper:
+            return None
+        return oldLower, self.lowerBound, oldUpper, self.upperBound
+
+    # Get the end value of this node's game once its bounds prove it, the best end value for the player to move
+    # of its proven children. It keeps the margin of left over pieces, like the end values of game overs,
+    # solved nodes and rollouts, so a proven node backs up scores on the same scale as the rest of the tree.
+    # If the children don't agree with the bounds (another worker is still passing theirs up), it's just the
+    # outcome the bounds give
+    def getProvenValue(self):
+
+        player = 1 - self.actionFor
+        bestValue = None
+        for i in range(len(self.children)):
+            if self.symmetricTo is not None and self.symmetricTo[i] != i:
+                continue
+            child = self.children[i]
+            if child is None or not child.isTerminal or child.terminalValue is None:
+                continue
+            if bestValue is None or child.terminalValue[player] > bestValue[player]:
+                bestValue = child.terminalValue
+
+        if bestValue is not None and getOutcome(bestValue[player]) == self.lowerBound:
+            return bestValue
+
+        if player == BLUE:
+            return self.lowerBound, 1 - self.lowerBound
+        else:
+            return 1 - self.lowerBound, self.lowerBound
+
+    # Prove this node from endValue, the end value of its position with best play, worked out by the endgame
+    # solver. Its children aren't needed for that, so it's proven without a terminalChild. Returns the same
+    # as updateBounds
+    def setSolved(self, endValue):
+
+        if self.isTerminal:
+            return None
+
+        oldLower = self.lowerBound
+        oldUpper = self.upperBound
+
+        self.lowerBound = getOutcome(endValue[1 - self.actionFor])
+        self.upperBound = self.lowerBound
+        self.terminalScore = self.lowerBound
+        self.terminalValue = endValue
+        self.isTerminal = True
+
+        if self.lowerBound == oldLower and self.upperBound == oldUpper:
+            return None
+        return oldLower, self.lowerBound, oldUpper, self.upperBound
+
     def updateWith(self, sims, endValue):
         self.sims += sims
         self.score += endValue[self.actionFor]
@@ -86,54 +286,102 @@ class Node:
     # This method finds the best available move for this node, attempts to maximize win chance
     def getBestChild(self):
 
-        # If this node is terminal, the terminal child maximizes our score, so if it is
-        # greater than 0, it's either a forced win for this node, or there is a tie
-        # with every other being either a tie or a loss. So if we are greater than 0,
-        # that's the best we can do, otherwise just uses the win chance and hope
-        # the other player doesn't see how to force their win
-        if self.isTerminal and self.terminalScore > 0:
-            return self.terminalChild
-
-        currentMaxWin = -float("inf")
+        # Proven outcomes come first: the most this node's player is proven to get from a child (1 minus the
+        # child's upper bound, a proven win before a proven tie before nothing known), then any move not proven
+        # lost, and only then the win chance. A proven child isn't searched anymore, so its win chance is left
+        # at whatever it was when it was proven, a proven loss can still look better than the moves left open.
+        # If every move is lost, this just uses the win chance and hopes the other player doesn't see how to
+        # force their win
+        bestKey = None
         bestChild = None
-        # Loop through all children to find the one with the greatest win chance
         for child in self.children:
-            if child is not None and child.getWinChance() > currentMaxWin:
-                currentMaxWin = child.getWinChance()
+            if child is None:
+                continue
+            key = (1 - child.upperBound, child.lowerBound < 1, child.getWinChance())
+            if bestKey is None or key > bestKey:
+                bestKey = key
                 bestChild = child
 
         return bestChild
 
-    # Get the child that has the highest UCT score, if child does not exist, create it
-    def getChildToExpandIndex(self):
+    # Get the network's probabilities of this node's moves, given a state at this node's position
+    def setChildProbs(self, state):
+
+        if self.moves is not None:
+            moves = self.moves
+        else:
+            moves = state.availableMoves
+
+        childProbs = Network.getCachedMoveProbs(state, self.moveProbFunc, moves)
+
+        if self.symmetricTo is not None:
+            # The move searched stands for all of its symmetric moves, so it gets their probability too
+            for i in range(len(childProbs)):
+                if self.symmetricTo[i] != i:
+                    childProbs[self.symmetricTo[i]] += childProbs[i]
+
+        self.childProbs = childProbs
+
+    # Get the child that has the highest UCT score, if child does not exist, create it. state is a state at
+    # this node's position (the node's own if not given), used to get the network's probabilities the first
+    # time through
+    def getChildToExpandIndex(self, state=None):
+
+        if self.childProbs is None and self.moveProbFunc is not None:
+            if state is None:
+                state = self.state
+            self.setChildProbs(state)
 
         maxUCT = -float("inf")
         bestChildIndex = None
+        provenChildIndex = None
+        symmetricTo = self.symmetricTo
 
         for i in range(len(self.children)):
 
+            if symmetricTo is not None and symmetricTo[i] != i:
+                # Searched as its symmetric move instead
+                continue
+
             if self.children[i] is None:
                 if self.childProbs is None:
                     # No child probs and child does not exist, just greedy explore
                     return i
                 else:
                     # Use UCT without win percent, just explore/probability
-                    UCT = self.explore * self.childProbs[i] * sqrt(log(self.sims))
+                    UCT = self.explore * self.childProbs[i] * sqrt(log(self.sims + self.virtualLoss))
+            elif self.children[i].isTerminal:
+                # Proven, searching it more can't tell us anything
+                provenChildIndex = i
+                continue
             else:
-                UCT = self.children[i].getUCT()
+                UCT = self.children[i].getUCT(self)
 
             if UCT >= maxUCT:
                 maxUCT = UCT
                 bestChildIndex = i
 
+        # Every move is proven, but this node's bounds haven't caught up yet (another worker is still
+        # passing them up, or another move order proved the children)
+        if bestChildIndex is None:
+            return provenChildIndex
+
         return bestChildIndex
 
-    def getUCT(self):
+    # With transpositions a node can have several parents, parent is the one it's being chosen from
+    def getUCT(self, parent=None):
+
+        if parent is None:
+            parent = self.parent
+
         # UCT formula as specified by wikipedia
         #return (self.score/self.sims) + self.explore * sqrt(log(self.parent.sims) / self.sims)
 
-        # UCT based on Alpha Zero, using probability to scale the explore factor seems to make the mose sense
-        return (self.score/self.sims) + self.explore * self.probability * sqrt(log(self.parent.sims) / self.sims)
+        # UCT based on Alpha Zero, using probability to scale the explore factor seems to make the mose sense.
+        # Simulations still in progress count as visits that scored nothing, so workers spread out
+        sims = self.sims + self.virtualLoss
+        parentSims = parent.sims + parent.virtualLoss
+        return (self.score/sims) + self.explore * self.probability * sqrt(log(parentSims) / sims)
 
     def getWinChance(self):
         return self.score / max(self.sims, 1)
@@ -144,12 +392,12 @@ class Node:
             if self.terminalScore == 0.5:
                 return 0
             elif self.terminalScore >= 1:
-                if self.state.turn == BLUE:
+                if self.actionFor == GREEN:  # Blue's turn
                     return 1
                 else:
                     return -1
             elif self.terminalScore <= 0:
-                if self.state.turn == BLUE:
+                if self.actionFor == GREEN:
                     return -1
                 else:
                     return 1
@@ -165,10 +413,22 @@ class Node:
 
         moveProbs = [[[0 for x in range(size + 1)] for y in range(size + 1)] for z in range(size + 1)]
 
+        moves = self.getMoves()
+
+        # Index of the child searched for each move, symmetric moves share its simulations between them
+        if self.symmetricTo is not None:
+            searchedFor = self.symmetricTo
+        else:
+            searchedFor = range(len(self.children))
+        shares = [0 for i in range(len(self.children))]
         for i in range(len(self.children)):
+            shares[searchedFor[i]] += 1
 
-            child = self.children[i]
-            move = self.state.availableMoves[i]
+        for i in range(len(self.children)):
+
+            searched = searchedFor[i]
+            child = self.children[searched]
+            move = moves[i]
 
             # Get x,y,z from move tuple
             x = move[0]
@@ -182,7 +442,80 @@ class Node:
             else:
                 #print("adding " + str(self.state.availableMoves[i]) + " : " + str(child.sims) + " : " + str((self.sims-1)))
                 #moveProbs.append((self.state.availableMoves[i], child.sims/(self.sims-1)))
-                moveProbs[x][y][z] = child.sims/(self.sims-1)
+                # A root made for a move the search hadn't reached starts without the extra simulation, and can
+                # be proven after only one
+                moveProbs[x][y][z] = child.sims/max(self.sims-1, 1)/shares[searched]
 
         return moveProbs
 
+
+# Node that only keeps the move that led to it, not its own State, so the tree's memory doesn't grow with the
+# board size. Only the root keeps a State. The search already follows moves down on its scratch state, so it
+# doesn't need the nodes' states, anything else asking for one gets it rebuilt from the root.
+class StatelessNode(Node):
+
+    def __init__(self, parent, state, probability=1, moveProbFunc=None, mergeSymmetric=False):
+        Node.__init__(self, parent, state, probability, moveProbFunc, mergeSymmetric)
+
+        # The moves are in the same order as the search's scratch state has them when walked here, so
+        # they aren't kept either. With transpositions the search gives each node a copy of its moves,
+        # since another move order can have them in a different order
+        self.moves = None
+
+    @property
+    def state(self):
+
+        if self.parent is None:
+            return self.rootState
+
+        # Collect the moves back up to the root, then play them forward on a copy of its state
+        moves = []
+        node = self
+        while node.parent is not None:
+            moves.append(node.move)
+            node = node.parent
+
+        state = CubiCupState.State(node.rootState.boardSize, node.rootState)
+        for move in reversed(moves):
+            state.takeTurn(move)
+
+        return state
+
+    @state.setter
+    def state(self, state):
+        # Only the root keeps its state
+        if self.parent is None:
+            self.rootState = state
+        else:
+            self.rootState = None
+
+    # Create a child from the ith available move. stateAfterMove isn't kept, so it doesn't need copying
+    def createChildAt(self, i, stateAfterMove=None, virtualLoss=0, pool=None):
+
+        if stateAfterMove is None:
+            state = self.state
+            stateAfterMove = CubiCupState.State(state.boardSize, state)
+            stateAfterMove.takeTurn(self.getMoves()[i])
+
+        if self.childProbs is None:
+            child = CubiCupNodePool.newNode(pool, CubiCupNode.StatelessNode, self, stateAfterMove,
+                                            moveProbFunc=self.moveProbFunc, mergeSymmetric=self.mergeSymmetric)
+        else:
+            child = CubiCupNodePool.newNode(pool, CubiCupNode.StatelessNode, self, stateAfterMove,
+                                            probability=self.childProbs[i], moveProbFunc=self.moveProbFunc,
+                                            mergeSymmetric=self.mergeSymmetric)
+
+        child.virtualLoss = virtualLoss
+        self.children[i] = child
+
+        # This node has a child, it is no longer a leaf
+        self.childrenUnexplored -= 1
+
+    def getMoves(self):
+        if self.moves is not None:
+            return self.moves
+        return self.state.availableMoves
+
+    def makeRoot(self):
+        self.rootState = self.state  # Rebuilt while the parents are still there
+        self.parent = None
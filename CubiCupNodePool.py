@@ -0,0 +1,50 @@
+# How many nodes a pool keeps when the tree has no node limit to size it by
+defaultPoolSize = 100000
+
+
+# Nodes the search has let go of, after the root moves or the tree is pruned, kept to be used again for new
+# nodes instead of being left to the garbage collector while new ones are allocated. Released nodes drop
+# everything they refer to, so a node waiting here costs only itself. At most maxSize are kept, any beyond
+# that are left to the garbage collector as before.
+class NodePool:
+
+    def __init__(self, maxSize=defaultPoolSize):
+        self.maxSize = maxSize
+        self.nodes = []
+
+    # Get a node of nodeClass, made with the same arguments as its constructor. Worker threads can call this
+    # at the same time, list.pop is atomic
+    def getNode(self, nodeClass, parent, state, probability=1, moveProbFunc=None, mergeSymmetric=False):
+
+        try:
+            node = self.nodes.pop()
+        except IndexError:
+            return nodeClass(parent, state, probability, moveProbFunc, mergeSymmetric)
+
+        if type(node) is not nodeClass:
+            # Only one kind of node is used in a tree, a node of another kind can just go
+            return nodeClass(parent, state, probability, moveProbFunc, mergeSymmetric)
+
+        node.__init__(parent, state, probability, moveProbFunc, mergeSymmetric)
+        return node
+
+    # Take a node that is no longer in the tree. Nothing may refer to it afterwards
+    def release(self, node):
+
+        node.parent = None
+        node.state = None
+        node.moves = None
+        node.children = None
+        node.terminalChild = None
+        node.childProbs = None
+        node.symmetricTo = None
+
+        if len(self.nodes) < self.maxSize:
+            self.nodes.append(node)
+
+
+# Get a node from pool, or a new one if there is no pool
+def newNode(pool, nodeClass, parent, state, probability=1, moveProbFunc=None, mergeSymmetric=False):
+    if pool is None:
+        return nodeClass(parent, state, probability, moveProbFunc, mergeSymmetric)
+    return pool.getNode(nodeClass, parent, state, probability, moveProbFunc, mergeSymmetric)
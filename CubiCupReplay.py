@@ -0,0 +1,154 @@
+import json
+import os
+import numpy as np
+import CubiCupShards
+
+# How many positions the buffer holds before the oldest are written over
+defaultCapacity = 2000000
+
+# How many of the latest generations' positions are trained on
+defaultWindow = 5
+
+# Part of the games held out for testing
+defaultTestShare = 0.2
+
+
+# Self-play positions of the last few generations of training, kept on disk in memory mapped arrays so training
+# only reads the positions it uses. The positions, policy targets, game results, the generation each position
+# was played by and the game it's from are each a .npy file in directory, all written as one ring of capacity
+# positions, so once full the oldest positions are written over. Only positions of the last window generations
+# are trained on, older ones are left where they are until they're written over. How full the ring is is kept in a small json file,
+# so a buffer is picked up again by any process opening the same directory
+class ReplayBuffer:
+
+    def __init__(self, directory, size, capacity=defaultCapacity, window=defaultWindow):
+        self.directory = directory
+        self.size = size
+        self.capacity = capacity
+        self.window = window
+
+        self.count = 0  # Positions in the ring, up to capacity
+        self.next = 0  # Where the next position goes
+        self.generation = -1  # Latest generation added
+        self.nextGame = 0  # Id of the next game added
+
+        os.makedirs(directory, exist_ok=True)
+
+        # Pick up where the buffer was left, unless it was for another board size or capacity, or from before
+        # games were kept
+        meta = self.readMeta()
+        if meta is not None and meta["size"] == size and meta["capacity"] == capacity and "nextGame" in meta:
+            self.count = meta["count"]
+            self.next = meta["next"]
+            self.generation = meta["generation"]
+            self.nextGame = meta["nextGame"]
+            mode = "r+"
+        else:
+            mode = "w+"
+
+        cube = (capacity, size + 1, size + 1, size + 1)
+        self.boards = self.openArray("boards.npy", np.int8, cube, mode)
+        self.policies = self.openArray("policies.npy", np.float32, cube, mode)
+        self.results = self.openArray("results.npy", np.int8, (capacity,), mode)
+        self.generations = self.openArray("generations.npy", np.int32, (capacity,), mode)
+        self.games = self.openArray("games.npy", np.int64, (capacity,), mode)
+
+    def openArray(self, fileName, dtype, shape, mode):
+        return np.lib.format.open_memmap(os.path.join(self.directory, fileName), mode=mode, dtype=dtype,
+                                         shape=shape if mode == "w+" else None)
+
+    def getMetaName(self):
+        return os.path.join(self.directory, "replay.json")
+
+    def readMeta(self):
+        if not os.path.exists(self.getMetaName()):
+            return None
+        with open(self.getMetaName(), "r") as file:
+            return json.load(file)
+
+    # Write everything added to disk, so the buffer can be opened again
+    def flush(self):
+
+        for data in (self.boards, self.policies, self.results, self.generations, self.games):
+            data.flush()
+
+        meta = {"size": self.size, "capacity": self.capacity, "count": self.count, "next": self.next,
+                "generation": self.generation, "nextGame": self.nextGame}
+        with open(self.getMetaName(), "w") as file:
+            json.dump(meta, file)
+
+    # Add shard records (see CubiCupShards.getRecordType) played by generation. The records' games are given
+    # ids after the games already in the buffer
+    def addRecords(self, records, generation):
+
+        if len(records) == 0:
+            return
+
+        games = self.nextGame + records["game"].astype(np.int64)
+        self.nextGame = int(games.max()) + 1
+
+        # Only the last capacity records would be left anyway
+        records = records[-self.capacity:]
+        games = games[-self.capacity:]
+
+        # Write up to the end of the ring, then the rest from its start
+        start = 0
+        while start < len(records):
+            count = min(len(records) - start, self.capacity - self.next)
+            end = self.next + count
+            self.boards[self.next:end] = records["board"][start:start + count]
+            self.policies[self.next:end] = records["policy"][start:start + count]
+            self.results[self.next:end] = records["result"][start:start + count]
+            self.generations[self.next:end] = generation
+            self.games[self.next:end] = games[start:start + count]
+            start += count
+            self.next = end % self.capacity
+            self.count = min(self.count + count, self.capacity)
+
+        self.generation = max(self.generation, generation)
+
+    # Add the positions of the shards of manifests, played by generation
+    def addShards(self, manifests, generation):
+        for manifest in manifests:
+            self.addRecords(CubiCupShards.readShard(manifest), generation)
+        self.flush()
+
+    # Get the indices of the positions in the window, the last window generations
+    def getWindow(self):
+        return np.flatnonzero(self.generations[:self.count] > self.generation - self.window)
+
+    # Split the window's positions into training and test indices, with testShare of its games picked at random
+    # for testing. Whole games are held out, positions of one game are too alike to test with the others trained
+    # on. Nothing is copied, positions are only read when they're gathered
+    def split(self, testShare=defaultTestShare, rng=None):
+
+        if rng is None:
+            rng = np.random.default_rng()
+
+        indices = self.getWindow()
+        games = self.games[indices]
+
+        windowGames = rng.permutation(np.unique(games))
+        testGames = windowGames[:int(len(windowGames) * testShare)]
+
+        isTest = np.isin(games, testGames)
+        return indices[~isTest], indices[isTest]
+
+    # Get the positions at indices, as (boards, policy targets, results) with boards and policies shaped as
+    # network input and output
+    def gather(self, indices):
+
+        # Reading in order keeps reads from the memory mapped files mostly sequential
+        indices = np.sort(indices)
+        shape = (len(indices), 1, self.size + 1, self.size + 1, self.size + 1)
+        return self.boards[indices].reshape(shape), self.policies[indices].reshape(shape), self.results[indices]
+
+    # Get a minibatch of batchSize positions picked at random from indices (the window if not given)
+    def sample(self, batchSize, indices=None, rng=None):
+
+        if rng is None:
+            rng = np.random.default_rng()
+        if indices is None:
+            indices = self.getWindow()
+
+        return self.gather(rng.choice(indices, size=min(batchSize, len(indices)), replace=False))
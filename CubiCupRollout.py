@@ -0,0 +1,212 @@
+import numpy as np
+import CubiCupTopology
+from CubiCupDriver import EMPTY
+from CubiCupDriver import BLUE
+from CubiCupDriver import GREEN
+
+# Batch rollout engines that have already been built, by board size
+batchRollouts = {}
+
+
+# Get the batch rollout engine for a board size, building it only the first time that size is asked for
+def getBatchRollout(size):
+    batchRollout = batchRollouts.get(size)
+    if batchRollout is None:
+        batchRollout = BatchRollout(size)
+        batchRollouts[size] = batchRollout
+    return batchRollout
+
+
+# Play random games from a state, returning the average end value over all of them
+def averageEndValue(state, games, rng=None):
+    endValues = getBatchRollout(state.boardSize).play([state], games, rng)
+    mean = endValues.mean(axis=0)
+    return float(mean[BLUE]), float(mean[GREEN])
+
+
+# Plays many random games at once, with every board a row of a NumPy array. Boards use the same
+# EMPTY/BASE/BLUE/GREEN values as State.getBoardArray(), flattened so column i is topology index i.
+# There is one extra column at the end that is always EMPTY, tables point at it where a spot doesn't
+# exist, so checks against it just fail instead of needing bounds checks.
+class BatchRollout:
+
+    def __init__(self, size):
+        topology = CubiCupTopology.getTopology(size)
+        self.size = size
+        self.topology = topology
+        self.numColumns = topology.numIndices + 1
+        missing = topology.numIndices
+
+        # Spots that can be played on, and the three spots each one sits on
+        self.cells = np.array(topology.cells, dtype=np.intp)
+        self.supports = np.array([topology.supports[i] for i in topology.cells], dtype=np.intp).reshape(-1, 3)
+
+        # For each index and each of the -x, -y, -z directions, the spot it can make a cup under, and the
+        # other two spots under that cup
+        self.cupTargets = np.full((self.numColumns, 3), missing, dtype=np.intp)
+        self.cupPartners = np.full((self.numColumns, 3, 2), missing, dtype=np.intp)
+        for index in topology.indexOf.values():
+            x, y, z = topology.coords[index]
+            for d, (coord, offset) in enumerate(((x, topology.layerLength), (y, topology.rowLength), (z, 1))):
+                if coord > 0:
+                    target = index - offset
+                    self.cupTargets[index, d] = target
+                    self.cupPartners[index, d] = [i for i in topology.supports[target] if i != index]
+
+        # A cascade of filled cups goes up one layer each time, so it is never deeper than the pyramid
+        self.maxFillDepth = size + 2
+
+        self.top = topology.top
+        self.topSupports = np.array(topology.supports[topology.top], dtype=np.intp)
+
+    # Get the board row of a state
+    def getBoardRow(self, state):
+        row = np.full(self.numColumns, EMPTY, dtype=np.int8)
+        row[:-1] = np.array(state.getBoardArray(), dtype=np.int8).reshape(-1)
+        return row
+
+    # Play gamesPerState random games from each state, returning an array of (blue, green) end values,
+    # as State.endValue would have them. Games for states[i] are rows i*gamesPerState to (i+1)*gamesPerState
+    def play(self, states, gamesPerState=1, rng=None):
+
+        if rng is None:
+            rng = np.random.default_rng()
+
+        numGames = len(states) * gamesPerState
+
+        boards = np.repeat(np.stack([self.getBoardRow(state) for state in states]), gamesPerState, axis=0)
+        pieces = np.repeat(np.array([state.pieces for state in states], dtype=np.float64), gamesPerState, axis=0)
+        turns = np.repeat(np.array([state.turn for state in states], dtype=np.int8), gamesPerState)
+        endValues = np.zeros((numGames, 2), dtype=np.float64)
+
+        # Games that are already over just keep the value they ended with
+        active = np.ones(numGames, dtype=bool)
+        for i, state in enumerate(states):
+            if state.gameOver:
+                endValues[i * gamesPerState:(i + 1) * gamesPerState] = state.endValue
+                active[i * gamesPerState:(i + 1) * gamesPerState] = False
+
+        games = np.nonzero(active)[0]
+
+        while games.size > 0:
+            self.takeRandomTurns(boards, pieces, turns, games, rng)
+            over = self.checkForEnd(boards, pieces, turns, games, endValues)
+            games = games[~over]
+
+        return endValues
+
+    # Take one random available move in each of games
+    def takeRandomTurns(self, boards, pieces, turns, games, rng):
+
+        gameBoards = boards[games]
+
+        # A spot is available if it is empty and the three spots below it are filled
+        occupied = gameBoards != EMPTY
+        available = ~occupied[:, self.cells] & occupied[:, self.supports[:, 0]] \
+            & occupied[:, self.supports[:, 1]] & occupied[:, self.supports[:, 2]]
+
+        # The available spot with the largest random key is a uniformly random available move
+        keys = rng.random(available.shape)
+        keys[~available] = -1.0
+        moves = self.cells[np.argmax(keys, axis=1)]
+
+        # Add moves to the boards
+        gameTurns = turns[games]
+        boards[games, moves] = gameTurns
+        pieces[games, gameTurns] -= 1
+
+        self.fill(boards, pieces, games, moves)
+
+        # Change turn, since someone just moved
+        turns[games] = 1 - gameTurns
+
+    # Fill cups the same way CubiCupDriver.fill does, one recursion step at a time for all games at once.
+    # Each game has its own stack of (spot, next direction to check) frames, standing in for the recursion
+    def fill(self, boards, pieces, games, moves):
+
+        # Most moves don't make a cup at all, only games where the placed cube did need the stacks
+        colors = boards[games, moves][:, np.newaxis]
+        partners = self.cupPartners[moves]
+        madeCup = ((boards[games[:, np.newaxis], partners[:, :, 0]] == colors)
+                   & (boards[games[:, np.newaxis], partners[:, :, 1]] == colors)).any(axis=1)
+        madeCup &= pieces[games, 1 - colors[:, 0]] != 0
+        games = games[madeCup]
+        moves = moves[madeCup]
+
+        numGames = games.size
+        stackCells = np.zeros((numGames, self.maxFillDepth), dtype=np.intp)
+        stackDirections = np.zeros((numGames, self.maxFillDepth), dtype=np.intp)
+        stackTops = np.zeros(numGames, dtype=np.intp)
+        stackCells[:, 0] = moves
+
+        while True:
+            # Games that still have frames on their stack
+            rows = np.nonzero(stackTops >= 0)[0]
+            if rows.size == 0:
+                break
+
+            tops = stackTops[rows]
+            directions = stackDirections[rows, tops]
+
+            # Frames that have checked all three directions return to the frame below them
+            done = directions >= 3
+            stackTops[rows[done]] -= 1
+            rows = rows[~done]
+            tops = tops[~done]
+            directions = directions[~done]
+            stackDirections[rows, tops] += 1
+
+            gameIndices = games[rows]
+            cells = stackCells[rows, tops]
+            colors = boards[gameIndices, cells]
+            fillColors = 1 - colors
+            targets = self.cupTargets[cells, directions]
+            partners = self.cupPartners[cells, directions]
+
+            # The player filling needs pieces left, and the other two spots under target need to match
+            valid = (pieces[gameIndices, fillColors] != 0) \
+                & (boards[gameIndices, partners[:, 0]] == colors) & (boards[gameIndices, partners[:, 1]] == colors)
+
+            fillRows = rows[valid]
+            fillGames = gameIndices[valid]
+            fillTargets = targets[valid]
+            fillColors = fillColors[valid]
+
+            # Add the piece to fill the cup, decrement players pieces, and check the cups it made next
+            boards[fillGames, fillTargets] = fillColors
+            pieces[fillGames, fillColors] -= 1
+            stackTops[fillRows] += 1
+            stackCells[fillRows, stackTops[fillRows]] = fillTargets
+            stackDirections[fillRows, stackTops[fillRows]] = 0
+
+    # Set the end values of games that are over, the same way State.checkForEnd does. Returns a mask of
+    # which of games are over
+    def checkForEnd(self, boards, pieces, turns, games, endValues):
+
+        gameBoards = boards[games]
+        gamePieces = pieces[games]
+        gameTurns = turns[games]
+
+        topColors = gameBoards[:, self.top]
+        below = gameBoards[:, self.topSupports]
+
+        topFilled = topColors != EMPTY
+        tie = topFilled & (below[:, 0] == below[:, 1]) & (below[:, 0] == below[:, 2]) & (below[:, 0] != topColors)
+        blueTop = topFilled & ~tie & (topColors == BLUE)
+        greenTop = topFilled & ~tie & (topColors == GREEN)
+        blueOut = ~topFilled & (gamePieces[:, BLUE] == 0) & (gameTurns == BLUE)
+        greenOut = ~topFilled & ~blueOut & (gamePieces[:, GREEN] == 0) & (gameTurns == GREEN)
+
+        values = np.zeros((games.size, 2), dtype=np.float64)
+        values[tie] = (0.5, 0.5)
+        values[blueTop] = (1, 0)
+        values[greenTop] = (0, 1)
+        values[blueOut, BLUE] = -gamePieces[blueOut, GREEN]
+        values[blueOut, GREEN] = 1 + gamePieces[blueOut, GREEN]
+        values[greenOut, BLUE] = 1 + gamePieces[greenOut, BLUE]
+        values[greenOut, GREEN] = -gamePieces[greenOut, BLUE]
+
+        over = topFilled | blueOut | greenOut
+        endValues[games[over]] = values[over]
+
+        return over
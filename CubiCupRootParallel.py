@@ -0,0 +1,205 @@
+import multiprocessing
+import queue
+import random
+import threading
+import CubiCupMCTS
+from CubiCupDriver import BLUE
+
+
+# Runs several independent MCTS searches from the same root, each in its own process with its own random
+# seed, and merges the statistics of the root's children. Workers only share what they send back, so
+# nothing in the search itself needs locking.
+class RootParallelMCTS:
+
+    def __init__(self, size, workers, modelName=None, statsInterval=0.2):
+        self.gameSize = size
+        self.workers = workers
+        self.modelName = modelName
+        self.statsInterval = statsInterval
+
+        # Which position the workers should be searching, stats about any other position are stale
+        self.game = 0
+        self.ply = 0
+
+        self.summaries = {}  # Latest root summary from each worker, by worker index
+        self.merged = None  # (best move, score, simulations) from the merged summaries
+        self.kill = False
+
+        self.statsQueue = multiprocessing.Queue()
+        self.commandQueues = []
+        self.processes = []
+        for i in range(workers):
+            commandQueue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=runRootWorker,
+                                              args=(i, size, random.randrange(2 ** 32), modelName,
+                                                    commandQueue, self.statsQueue, statsInterval))
+            process.daemon = True
+            self.commandQueues.append(commandQueue)
+            self.processes.append(process)
+
+        self.commandLock = threading.Lock()
+
+    def sendToWorkers(self, command):
+        for commandQueue in self.commandQueues:
+            commandQueue.put(command)
+
+    def indicateReset(self, size):
+        with self.commandLock:
+            self.gameSize = size
+            self.game += 1
+            self.ply = 0
+            self.merged = None
+            self.sendToWorkers(("newGame", size))
+
+    def updateWithTurn(self, move):
+        with self.commandLock:
+            self.ply += 1
+            self.merged = None
+            self.sendToWorkers(("move", move))
+
+    def end(self):
+        self.kill = True
+
+    # Get the merged (best move, score, simulations), or None if no worker has reported on the current position
+    def getMergedValues(self):
+        return self.merged
+
+    # Start the workers, then collect their stats until ended
+    def run(self):
+
+        for process in self.processes:
+            process.start()
+
+        while not self.kill:
+            try:
+                workerIndex, game, ply, summary = self.statsQueue.get(timeout=self.statsInterval)
+            except queue.Empty:
+                continue
+
+            with self.commandLock:
+                if game != self.game or ply != self.ply:
+                    continue
+                self.summaries[workerIndex] = (game, ply, summary)
+                current = [s for g, p, s in self.summaries.values() if g == self.game and p == self.ply]
+                self.merged = mergeSummaries(current)
+
+        self.sendToWorkers(("end",))
+        for process in self.processes:
+            process.join(5)
+
+
+# Summarize a root for the coordinator: the player to move, simulations, and (move, sims, score, terminal score
+# or None, lower bound, upper bound) for each child that has been searched. Moves are turned into the game's
+# orientation with toGameMove, if the tree can be turned from it
+def summarizeRoot(root, toGameMove=None):
+
+    if toGameMove is None:
+        def toGameMove(move):
+            return move
+
+    children = []
+    for child in root.children:
+        if child is not None:
+            terminalScore = child.getScore() if child.isTerminal else None
+            children.append((toGameMove(root.getChildMove(child)), child.sims, child.score, terminalScore,
+                             child.lowerBound, child.upperBound))
+
+    return root.state.turn, root.sims, children
+
+
+# Merge worker root summaries, summing each child's simulations and score over all workers. Returns the
+# (best move, score, simulations) that a single search's root.getBestChild() would report from those totals
+def mergeSummaries(summaries):
+
+    if not summaries:
+        return None
+
+    totalSims = 0
+    moveStats = {}  # move -> [sims, score, terminal score, lower bound, upper bound]
+
+    for turn, sims, children in summaries:
+        totalSims += sims
+        for move, childSims, childScore, terminalScore, lowerBound, upperBound in children:
+            stats = moveStats.setdefault(move, [0, 0, None, 0, 1])
+            stats[0] += childSims
+            stats[1] += childScore
+            if terminalScore is not None:
+                stats[2] = terminalScore
+            # Whatever a worker proved holds for all of them, so the bounds are the tightest any worker has
+            stats[3] = max(stats[3], lowerBound)
+            stats[4] = min(stats[4], upperBound)
+
+    # Ranked the way Node.getBestChild ranks children, proven outcomes first, then moves not proven lost, then
+    # win chance
+    bestMove = None
+    bestKey = None
+    bestWinChance = None
+    for move, stats in moveStats.items():
+        winChance = stats[1] / max(stats[0], 1)
+        key = (1 - stats[4], stats[3] < 1, winChance)
+        if bestKey is None or key > bestKey:
+            bestKey = key
+            bestMove = move
+            bestWinChance = winChance
+
+    if bestMove is None:
+        return None
+
+    # Score the best move the way Node.getScore does, from the view of the player who moved
+    if moveStats[bestMove][2] is not None:
+        score = moveStats[bestMove][2]
+    elif summaries[0][0] == BLUE:
+        score = 2 * bestWinChance - 1
+    else:
+        score = -(2 * bestWinChance - 1)
+
+    return bestMove, score, totalSims
+
+
+# Worker process, searches with its own MCTS and sends root summaries every statsInterval seconds
+def runRootWorker(workerIndex, size, seed, modelName, commandQueue, statsQueue, statsInterval):
+
+    import CubiCupEngine
+
+    random.seed(seed)
+
+    if modelName is not None:
+        outputFunc = CubiCupEngine.getModelOutputFunc(modelName, size)
+    else:
+        outputFunc = None
+
+    mcts = CubiCupMCTS.MCTS(size, moveProbFunc=outputFunc)
+    mctsThread = threading.Thread(target=mcts.run)
+    mctsThread.daemon = True
+    mctsThread.start()
+
+    game = 0
+    ply = 0
+
+    while True:
+        try:
+            command = commandQueue.get(timeout=statsInterval)
+        except queue.Empty:
+            command = None
+
+        if command is not None:
+            if command[0] == "move":
+                mcts.updateWithTurn(command[1])
+                ply += 1
+            elif command[0] == "newGame":
+                mcts.indicateReset(command[1])
+                game += 1
+                ply = 0
+            elif command[0] == "end":
+                mcts.end()
+                mctsThread.join()
+                return
+            continue
+
+        # Don't report until the search has actually moved to the new root
+        if mcts.newRootReady or mcts.reset:
+            continue
+
+        with mcts.control:
+            summary = summarizeRoot(mcts.root, mcts.toGameMove)
+        statsQueue.put((workerIndex, game, ply, summary))
@@ -0,0 +1,117 @@
+import os
+import numpy as np
+
+# How many positions a shard holds before the next one is started
+defaultShardPositions = 50000
+
+
+# Get the NumPy record type of one position of a board size: the board as network input (EMPTY/BASE/BLUE/GREEN
+# values), the policy target (the search's move probabilities), the game's result (1 Blue won, 0 tie, -1 Green
+# won) and which game of its shard it's from. Shard files are these records one after another, so they can be
+# appended to and memory mapped as they are
+def getRecordType(size):
+    cube = (size + 1, size + 1, size + 1)
+    return np.dtype([("board", np.int8, cube), ("policy", np.float32, cube), ("result", np.int8),
+                     ("game", np.int32)])
+
+
+# Self-play positions written to shard files as games finish, so games never have to be kept or sent anywhere.
+# Shards are files named prefix_n.bin in directory, each is only ever appended to, and closed once it has
+# maxPositions positions (the game finishing it can take it a little over). Every closed shard is described by
+# a manifest, a small dict of its file name, board size, positions and games, which is all readers need
+class ShardWriter:
+
+    def __init__(self, directory, prefix, size, maxPositions=defaultShardPositions):
+        self.directory = directory
+        self.prefix = prefix
+        self.size = size
+        self.maxPositions = maxPositions
+        self.recordType = getRecordType(size)
+        self.shards = 0
+        self.file = None
+        self.positions = 0
+        self.games = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    # Write a finished game's positions, rebuilt from its record, with the game's result. Returns a list of the
+    # manifests of shards closed, empty if the current one still has room
+    def addGame(self, game):
+
+        if self.file is None:
+            self.fileName = os.path.join(self.directory, self.prefix + "_" + str(self.shards) + ".bin")
+            self.file = open(self.fileName, "wb")
+            self.shards += 1
+
+        numMoves = game.getNumMoves()
+        records = np.zeros(numMoves, dtype=self.recordType)
+        i = 0
+        for state, moveProbs in game.getHistory():
+            records["board"][i] = state.getBoardArray()
+            records["policy"][i] = moveProbs
+            i += 1
+        records["result"] = game.endValue
+        records["game"] = self.games
+
+        self.file.write(records.tobytes())
+        self.positions += numMoves
+        self.games += 1
+
+        if self.positions >= self.maxPositions:
+            return [self.closeShard()]
+        return []
+
+    # Close the current shard, returning its manifest
+    def closeShard(self):
+
+        self.file.close()
+        manifest = {"fileName": self.fileName, "size": self.size, "positions": self.positions, "games": self.games}
+
+        self.file = None
+        self.positions = 0
+        self.games = 0
+        return manifest
+
+    # Close the current shard, if it has anything in it. Returns a list of the manifests of shards closed
+    def close(self):
+        if self.file is None:
+            return []
+        return [self.closeShard()]
+
+
+# Get a shard's records from its manifest, memory mapped, so they're only read from disk as they're used
+def readShard(manifest):
+    return np.memmap(manifest["fileName"], dtype=getRecordType(manifest["size"]), mode="r",
+                     shape=(manifest["positions"],))
+
+
+# The positions of several shards, indexed one after another as if they were one array, without reading them in
+class ShardSet:
+
+    def __init__(self, manifests):
+        self.manifests = manifests
+        self.size = manifests[0]["size"]
+        self.shards = [readShard(manifest) for manifest in manifests]
+
+        # Index of the first position of each shard, and one past the last of them all
+        self.starts = np.cumsum([0] + [manifest["positions"] for manifest in manifests])
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    # Get the indices of every position
+    def getIndices(self):
+        return np.arange(len(self))
+
+    # Get the positions at indices, as (boards, policy targets, results) with boards and policies shaped as
+    # network input and output
+    def gather(self, indices):
+
+        indices = np.sort(indices)
+        shardOf = np.searchsorted(self.starts, indices, side="right") - 1
+
+        records = np.concatenate([self.shards[shard][indices[shardOf == shard] - self.starts[shard]]
+                                  for shard in np.unique(shardOf)])
+
+        shape = (len(indices), 1, self.size + 1, self.size + 1, self.size + 1)
+        return records["board"].reshape(shape), records["policy"].reshape(shape), records["result"]
@@ -0,0 +1,124 @@
+import CubiCupState
+from CubiCupDriver import BLUE
+from CubiCupDriver import getEmptyCount
+
+# How many positions the transposition table keeps before it's started over
+defaultTableSize = 1000000
+
+# How a table entry's value bounds the position's real value
+EXACT = 0
+LOWER = 1  # The value is at least this
+UPPER = 2  # The value is at most this
+
+
+# Exact solver for the end of a game, when few enough cube spots are left empty that every move can be looked
+# at. A negamax alpha-beta search over the rules, with a transposition table of positions by Zobrist hash, so
+# positions reached by different move orders are only solved once. Values are the end values the rules give,
+# with the margin of left over pieces, for the player to move, so the best game for one player is the best
+# game for the other with the value taken from 1 (end values always add up to 1).
+class EndgameSolver:
+
+    def __init__(self, maxEntries=defaultTableSize):
+        self.maxEntries = maxEntries
+        self.table = {}  # Hash -> (value, EXACT/LOWER/UPPER, best move)
+
+    # Get the end value of state's game with best play by both players, and the best move for the player to
+    # move (None if the game is over). Several threads can solve at once, they share the table
+    def solve(self, state):
+
+        if len(self.table) >= self.maxEntries:
+            # Start over, searches in progress keep the table they started with
+            self.table = {}
+        table = self.table
+
+        # Solve on a copy, making and unmaking moves on it
+        position = CubiCupState.State(state.boardSize, state)
+        value = self.negamax(position, -float("inf"), float("inf"), table)
+
+        if position.gameOver:
+            return position.endValue, None
+
+        bestMove = table[position.hash][2]
+        if position.turn == BLUE:
+            return (value, 1 - value), bestMove
+        else:
+            return (1 - value, value), bestMove
+
+    # Get the value of state for the player to move, if it's between alpha and beta. Otherwise the value
+    # returned is only a bound, at most alpha or at least beta, and the real value is at least as far out
+    def negamax(self, state, alpha, beta, table):
+
+        if state.gameOver:
+            return state.endValue[state.turn]
+
+        entry = table.get(state.hash)
+        firstMove = None
+        if entry is not None:
+            value, bound, firstMove = entry
+            if bound == EXACT:
+                return value
+            elif bound == LOWER:
+                alpha = max(alpha, value)
+            else:
+                beta = min(beta, value)
+            if alpha >= beta:
+                return value
+
+        startAlpha = alpha
+        bestValue = -float("inf")
+        bestMove = None
+        for move in self.orderMoves(state, firstMove):
+
+            state.makeMove(move)
+            # Whatever the other player gets, this player gets the rest
+            value = 1 - self.negamax(state, 1 - beta, 1 - alpha, table)
+            state.unmakeMove()
+
+            if value > bestValue:
+                bestValue = value
+                bestMove = move
+                if value > alpha:
+                    alpha = value
+                    if alpha >= beta:
+                        # The other player won't allow this, they have better earlier on
+                        break
+
+        if bestValue <= startAlpha:
+            table[state.hash] = (bestValue, UPPER, bestMove)
+        elif bestValue >= beta:
+            table[state.hash] = (bestValue, LOWER, bestMove)
+        else:
+            table[state.hash] = (bestValue, EXACT, bestMove)
+
+        return bestValue
+
+    # Get state's available moves in the order to search them, firstMove (the best move the last time the
+    # position was searched) first, then moves that make a cup, which change the piece count and so usually
+    # decide the game, then the rest
+    def orderMoves(self, state, firstMove=None):
+
+        mine = state.board[state.turn]
+        cups = state.topology.cups
+        indexOf = state.topology.indexOf
+
+        cupMoves = []
+        otherMoves = []
+        for move in state.availableMoves:
+            if move == firstMove:
+                continue
+            for target, targetBit, partners in cups[indexOf[move]]:
+                if mine & partners == partners:
+                    cupMoves.append(move)
+                    break
+            else:
+                otherMoves.append(move)
+
+        if firstMove is not None and firstMove in state.availableMoves:
+            cupMoves.insert(0, firstMove)
+
+        return cupMoves + otherMoves
+
+
+# Whether state is far enough into its game, with at most cells cube spots left empty, for the solver
+def isEndgame(state, cells):
+    return getEmptyCount(state.board, state.topology) <= cells
@@ -1,13 +1,17 @@
 import CubiCupDriver
+import CubiCupTopology
+import CubiCupMoveSet
 
 from CubiCupDriver import BLUE
 from CubiCupDriver import GREEN
-from CubiCupDriver import EMPTY
+from CubiCupDriver import OCCUPIED
 from CubiCupDriver import addMoveToBoard
+from CubiCupDriver import boardToArray
 from CubiCupDriver import fill
+from CubiCupDriver import getHash
+from CubiCupDriver import getSymmetricHashes
 from CubiCupDriver import getAvailableMoves
 from CubiCupDriver import updateAvailableMoves
-import copy
 
 
 class State:
@@ -15,18 +19,22 @@ class State:
     def __init__(self, size, stateToCopy=None):
 
         if stateToCopy is not None:
-            # If state to copy is specified, copy all the stuff from it
-            self.board = copy.deepcopy(stateToCopy.board)
-            self.pieces = copy.deepcopy(stateToCopy.pieces)
+            # If state to copy is specified, copy all the stuff from it. The board is a list of
+            # immutable bitboards and the moves are tuples, so shallow copies are enough
+            self.board = list(stateToCopy.board)
+            self.pieces = list(stateToCopy.pieces)
             self.turn = stateToCopy.turn
             self.gameOver = stateToCopy.gameOver
             self.endValue = stateToCopy.endValue
             self.boardSize = stateToCopy.boardSize
-            self.availableMoves = copy.deepcopy(stateToCopy.availableMoves)
+            self.topology = stateToCopy.topology
+            self.availableMoves = CubiCupMoveSet.MoveSet(stateToCopy.availableMoves)
             self.lastMove = stateToCopy.lastMove
+            self.hash = stateToCopy.hash
+            self.journal = []  # A copy can't unmake moves made before it was copied
         else:
-            # Create (size+1)^3 array
-            self.board = [[[EMPTY for x in range(size + 1)] for y in range(size + 1)] for z in range(size + 1)]
+            # Create blue, green and occupied bitboards
+            self.board = CubiCupDriver.getEmptyBoard()
 
             # Use the driver(rules) to set the initial board values, just filling in the base cubes
             CubiCupDriver.getInitialBoard(size, self.board)
@@ -51,14 +59,46 @@ class State:
             self.gameOver = False  # Game doesn't start out over
             self.endValue = None
             self.boardSize = size  # Set board size
+            self.topology = CubiCupTopology.getTopology(size)  # Neighbour and cup tables for this size
             self.lastMove = None
-            self.availableMoves = []  # Create array for available moves
+            self.availableMoves = CubiCupMoveSet.MoveSet()  # Create set for available moves
+            self.journal = []  # Undo records of moves made with makeMove
 
             # Determine which moves are available, given the current board state
-            getAvailableMoves(self.board, self.boardSize, self.availableMoves)
+            getAvailableMoves(self.board, self.topology, self.availableMoves)
+
+            # Zobrist hash of the position, kept up to date as moves are taken
+            self.hash = getHash(self.board, self.topology, self.turn)
 
         self.checkForEnd()
 
+    # Pickle without the topology, which is rebuilt (or found in the cache) from the board size, and
+    # without the journal, which only makes sense for this object
+    def __getstate__(self):
+        fields = dict(self.__dict__)
+        del fields["topology"]
+        del fields["journal"]
+        return fields
+
+    def __setstate__(self, fields):
+        self.__dict__.update(fields)
+        self.topology = CubiCupTopology.getTopology(self.boardSize)
+        self.journal = []
+
+    # Make this state the same as another one, reusing this state's objects instead of creating new ones
+    def copyFrom(self, stateToCopy):
+        self.board[:] = stateToCopy.board
+        self.pieces[:] = stateToCopy.pieces
+        self.turn = stateToCopy.turn
+        self.gameOver = stateToCopy.gameOver
+        self.endValue = stateToCopy.endValue
+        self.boardSize = stateToCopy.boardSize
+        self.topology = stateToCopy.topology
+        self.availableMoves.copyFrom(stateToCopy.availableMoves)
+        self.lastMove = stateToCopy.lastMove
+        self.hash = stateToCopy.hash
+        self.journal.clear()
+
     def lastTurn(self):
         if self.turn == BLUE:
             return GREEN
@@ -72,16 +112,25 @@ class State:
         if self.gameOver:
             return
 
-        # Get x,y,z from move tuple
-        x = move[0]
-        y = move[1]
-        z = move[2]
+        # Get board index from move tuple
+        index = self.topology.indexOf[move]
 
         # Add move to the board
-        addMoveToBoard(self.board, x, y, z, self.turn, self.pieces)
+        addMoveToBoard(self.board, index, self.turn, self.pieces)
 
         # Fill cups that may have been created
-        filled = fill(self.board, x, y, z, self.turn, self.pieces)
+        filledCells = []
+        fill(self.board, self.topology, index, self.turn, self.pieces, filledCells)
+
+        # Update the hash with the placed cube, every cube the cups were filled with, and the turn change
+        zobrist = self.topology.zobrist
+        hash = self.hash ^ zobrist[self.turn][index] ^ self.topology.zobristTurn
+        for filled in filledCells:
+            if self.board[BLUE] >> filled & 1:
+                hash ^= zobrist[BLUE][filled]
+            else:
+                hash ^= zobrist[GREEN][filled]
+        self.hash = hash
 
         # Change turn, since someone just moved
         if self.turn == BLUE:
@@ -93,15 +142,8 @@ class State:
 
         self.lastMove = move
 
-        if filled:
-            # Algorithm to determine available moves when cups are filled isn't much more efficient re-determining
-            # all available, unless game is large, maybe we should consider this for large games
-            self.availableMoves = []
-            getAvailableMoves(self.board, self.boardSize, self.availableMoves)
-        else:
-            # No cup was filled, so the available moves left are just the ones before with the
-            # taken move removed. No need to redetermine all available.
-            updateAvailableMoves(self.board, self.availableMoves, self.lastMove)
+        # Remove the taken move, and add the moves created by it and by any cups that were filled
+        updateAvailableMoves(self.board, self.topology, self.availableMoves, self.lastMove, filledCells)
 
         # we now have a new state, and the available moves should be associate with new
 
@@ -109,16 +151,91 @@ class State:
         # send neural net the board state
         # get back value and of the state and move probablities
 
+    # Take a turn like takeTurn, but record what changed so it can be undone with unmakeMove
+    def makeMove(self, move):
+
+        # Record everything a turn can change. The old bitboards are the board without the placed
+        # cube and every cube the fill cascade added, so they're all that is needed to remove them.
+        # The move is removed from its position in the move set, and the moves it created are appended
+        if self.gameOver:
+            position = None
+            numMoves = 0
+        else:
+            position = self.availableMoves.index(move)
+            numMoves = len(self.availableMoves)
+
+        entry = (self.board[BLUE], self.board[GREEN], self.board[OCCUPIED], self.pieces[BLUE], self.pieces[GREEN],
+                 self.turn, self.gameOver, self.endValue, self.lastMove, self.hash, position, numMoves)
+
+        self.takeTurn(move)
+
+        self.journal.append(entry)
+
+    # Undo the last move made with makeMove
+    def unmakeMove(self):
+
+        blue, green, occupied, bluePieces, greenPieces, turn, gameOver, endValue, lastMove, hash, \
+            position, numMoves = self.journal.pop()
+
+        if position is not None:
+            # A move was actually taken, remove the moves it created and put it back where it was
+            moves = self.availableMoves
+            for i in range(len(moves) - (numMoves - 1)):
+                moves.pop()
+            moves.insertAt(self.lastMove, position)
+
+        self.board[BLUE] = blue
+        self.board[GREEN] = green
+        self.board[OCCUPIED] = occupied
+        self.pieces[BLUE] = bluePieces
+        self.pieces[GREEN] = greenPieces
+        self.turn = turn
+        self.gameOver = gameOver
+        self.endValue = endValue
+        self.lastMove = lastMove
+        self.hash = hash
+
+    # Get this position's hash in each of its six orientations, in the order of topology.permutations
+    def getSymmetricHashes(self):
+        return getSymmetricHashes(self.board, self.topology, self.turn)
+
+    # Get the canonical hash of this position, the smallest hash of its orientations, and the permutation
+    # that turns this position into that orientation. Positions that are the same but turned have the same
+    # canonical hash, so it's what caches of positions should use
+    def getCanonical(self):
+        hashes = self.getSymmetricHashes()
+        i = hashes.index(min(hashes))
+        return hashes[i], self.topology.permutations[i]
+
+    # Get the permutations, other than the identity, that leave this position the same
+    def getSymmetries(self):
+        hashes = self.getSymmetricHashes()
+        return [self.topology.permutations[i] for i in range(1, len(hashes)) if hashes[i] == hashes[0]]
+
+    # Get the board as a (size+1)^3 nested list of EMPTY/BASE/BLUE/GREEN values, as used by the network
+    def getBoardArray(self):
+        return boardToArray(self.board, self.boardSize)
+
     def checkForEnd(self):
 
-        if self.board[0][0][0] != EMPTY:
-            if self.board[1][0][0] == self.board[0][1][0] and self.board[1][0][0] == self.board[0][0][1] \
-                    and self.board[0][0][0] != self.board[1][0][0]:
+        # Bits of the top cube and the three cubes it sits on
+        top = self.topology.topBit
+        below = self.topology.topSupportMask
+
+        if self.board[OCCUPIED] & top:
+            if self.board[BLUE] & top:
+                topColor = BLUE
+            else:
+                topColor = GREEN
+            colored = self.board[BLUE] | self.board[GREEN]
+
+            # The three cubes below are all the other color, or all base cubes (only on a size 1 board)
+            if self.board[1 - topColor] & below == below or not colored & below:
 
                 # this is a tie
                 self.endValue = (0.5, 0.5)
             else:
-                if self.board[0][0][0] == BLUE:
+                if topColor == BLUE:
                     # blue wins
                     self.endValue = (1, 0)
                 else:
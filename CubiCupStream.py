@@ -0,0 +1,104 @@
+import collections
+import concurrent.futures
+import itertools
+import numpy as np
+
+# Positions in a training batch
+defaultBatchSize = 128
+
+# Threads reading batches, and how many batches are read ahead of training
+defaultThreads = 4
+defaultPrefetch = 8
+
+# Every way the board's axes can be permuted, the game is the same with its board turned any of these ways
+permutations = list(itertools.permutations(range(3)))
+
+
+# Turn batches of boards and policies, shaped as network input and output, with their axes permuted by
+# permutation, so a move turned by permuteMove is where the turned policy has it
+def permuteBatch(boards, policies, permutation):
+    axes = (0, 1, 2 + permutation[0], 2 + permutation[1], 2 + permutation[2])
+    return boards.transpose(axes), policies.transpose(axes)
+
+
+# Turn each position of a batch a way picked at random
+def augmentRandom(boards, policies, rng):
+
+    choices = rng.integers(len(permutations), size=len(boards))
+    for i in range(len(permutations)):
+        chosen = choices == i
+        boards[chosen], policies[chosen] = permuteBatch(boards[chosen], policies[chosen], permutations[i])
+
+    return boards, policies
+
+
+# Get a batch of every position of a batch turned every way, six times the size
+def augmentAll(boards, policies):
+
+    turned = [permuteBatch(boards, policies, permutation) for permutation in permutations]
+    return np.concatenate([board for board, policy in turned]), np.concatenate([policy for board, policy in turned])
+
+
+# Training batches streamed from a source of positions (anything with gather(indices) giving boards, policy
+# targets and results, like CubiCupShards.ShardSet or CubiCupReplay.ReplayBuffer), so only the batches being
+# read and trained on are ever in memory. Each epoch goes through indices (the positions to use) once, shuffled
+# if shuffle is set. Batches are read from the source by a pool of threads, up to prefetch batches ahead, so
+# reading the next batches overlaps training on this one. Iterating gives (boards, policies) batches epoch
+# after epoch without end, len() is the number of batches in an epoch. Positions can be turned as they're read,
+# with augment "random" turning each a random way, and "all" giving each turned every way (batches six times
+# batchSize), so the same games train on every way the board can be turned
+class BatchStream:
+
+    def __init__(self, source, indices, batchSize=defaultBatchSize, shuffle=True, augment=None,
+                 threads=defaultThreads, prefetch=defaultPrefetch, rng=None):
+        self.source = source
+        self.indices = np.asarray(indices)
+        if len(self.indices) == 0:
+            # There would never be a batch to give, iterating would wait for one forever
+            raise ValueError("BatchStream needs at least one position")
+        self.batchSize = batchSize
+        self.shuffle = shuffle
+        self.augment = augment
+        self.threads = threads
+        self.prefetch = prefetch
+        self.rng = rng if rng is not None else np.random.default_rng()
+
+    def __len__(self):
+        return (len(self.indices) + self.batchSize - 1) // self.batchSize
+
+    # Get the indices of each batch, for epoch after epoch
+    def getBatchIndices(self):
+
+        while True:
+            if self.shuffle:
+                epochIndices = self.rng.permutation(self.indices)
+            else:
+                epochIndices = self.indices
+            for start in range(0, len(epochIndices), self.batchSize):
+                yield epochIndices[start:start + self.batchSize]
+
+    # Read a batch, turning it with a generator seeded by seed, as generators can't be shared between threads
+    def readBatch(self, batchIndices, seed):
+
+        boards, policies, results = self.source.gather(batchIndices)
+        boards = boards.astype(np.float32)
+
+        if self.augment == "random":
+            boards, policies = augmentRandom(boards, policies, np.random.default_rng(seed))
+        elif self.augment == "all":
+            boards, policies = augmentAll(boards, policies)
+
+        return boards, policies
+
+    def __iter__(self):
+
+        batchIndices = self.getBatchIndices()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) as executor:
+
+            # Batches being read, in the order they're given out
+            pending = collections.deque()
+            while True:
+                while len(pending) < self.prefetch:
+                    seed = self.rng.integers(2 ** 32)
+                    pending.append(executor.submit(self.readBatch, next(batchIndices), seed))
+                yield pending.popleft().result()
@@ -0,0 +1,155 @@
+import mmap
+import os
+import struct
+import sys
+import CubiCupState
+from CubiCupDriver import BLUE
+from CubiCupDriver import invertPermutation
+from CubiCupDriver import permuteMove
+
+# Largest board size whose positions can all be solved, bigger boards have far too many
+maxTablebaseSize = 4
+
+# A tablebase file is a header, then one record for every position reached before the game is over, sorted by
+# canonical hash so a position is found by binary search. Each record is the canonical hash, Blue's end value
+# with best play times two (values are whole or halves), and the index of the best move in the canonical
+# orientation
+fileMagic = b"CCTB"
+headerFormat = struct.Struct("<4sII")  # Magic, board size, number of records
+recordFormat = struct.Struct("<QhB")
+
+
+# Get the name of the tablebase file of a board size, in directory
+def getTablebaseName(size, directory=""):
+    return os.path.join(directory, "tablebase_" + str(size) + ".bin")
+
+
+# Solved positions of one board size, read from a tablebase file. The file is memory mapped, so it's only
+# read from disk as positions are looked up, and processes using the same file share it
+class Tablebase:
+
+    def __init__(self, file, data):
+        self.file = file
+        self.data = data
+        magic, self.size, self.numRecords = headerFormat.unpack_from(data, 0)
+
+    # Get the end value of state's game with best play by both players, and the best move for the player to
+    # move, in state's orientation. None if state is from another board size or isn't in the table (the
+    # game is over)
+    def probe(self, state):
+
+        if state.boardSize != self.size:
+            return None
+
+        key, permutation = state.getCanonical()
+
+        # Binary search the records for the canonical hash
+        low = 0
+        high = self.numRecords
+        while low < high:
+            middle = (low + high) // 2
+            recordKey, value, moveIndex = recordFormat.unpack_from(self.data, headerFormat.size +
+                                                                   middle * recordFormat.size)
+            if recordKey < key:
+                low = middle + 1
+            elif recordKey > key:
+                high = middle
+            else:
+                blueValue = value / 2
+                # The move is stored turned the canonical way, turn it back to state's orientation
+                move = permuteMove(state.topology.coords[moveIndex], invertPermutation(permutation))
+                return (blueValue, 1 - blueValue), move
+
+        return None
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+
+# Open the tablebase file fileName, None if there isn't one, or it isn't a tablebase
+def openTablebase(fileName):
+
+    if not os.path.exists(fileName) or os.path.getsize(fileName) < headerFormat.size:
+        return None
+
+    file = open(fileName, "rb")
+    data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    if headerFormat.unpack_from(data, 0)[0] != fileMagic:
+        data.close()
+        file.close()
+        return None
+
+    return Tablebase(file, data)
+
+
+# Solve every position of a board size that can be reached from the start, returning a dict of canonical hash
+# -> (Blue's end value with best play, index of the best move in the canonical orientation). Positions turned
+# some way from each other are the same position, so only one of them is solved
+def solveAll(size):
+
+    table = {}
+    solvePosition(CubiCupState.State(size), table)
+    return table
+
+
+# Get Blue's end value of state's game with best play, solving every position after it into table
+def solvePosition(state, table):
+
+    key, permutation = state.getCanonical()
+    entry = table.get(key)
+    if entry is not None:
+        return entry[0]
+
+    if state.gameOver:
+        # Game overs aren't kept, they're only solved once each time they're reached
+        return state.endValue[BLUE]
+
+    bestValue = None
+    bestMove = None
+    for move in list(state.availableMoves):
+
+        state.makeMove(move)
+        value = solvePosition(state, table)
+        state.unmakeMove()
+
+        # Blue wants the most of Blue's end value, and Green the least
+        if bestValue is None or (value > bestValue if state.turn == BLUE else value < bestValue):
+            bestValue = value
+            bestMove = move
+
+    table[key] = (bestValue, state.topology.indexOf[permuteMove(bestMove, permutation)])
+    return bestValue
+
+
+# Write a table from solveAll to a tablebase file for size
+def writeTablebase(table, size, fileName):
+
+    with open(fileName, "wb") as file:
+        file.write(headerFormat.pack(fileMagic, size, len(table)))
+        for key in sorted(table):
+            value, moveIndex = table[key]
+            file.write(recordFormat.pack(key, int(value * 2), moveIndex))
+
+
+# Generate the tablebase files for the board sizes given on the command line (all of them if none are), in the
+# current directory
+def main():
+
+    if len(sys.argv) > 1:
+        sizes = [int(arg) for arg in sys.argv[1:]]
+    else:
+        sizes = range(1, maxTablebaseSize + 1)
+
+    for size in sizes:
+        if size > maxTablebaseSize:
+            print("Size", size, "has too many positions to solve, skipping it")
+            continue
+        table = solveAll(size)
+        fileName = getTablebaseName(size)
+        writeTablebase(table, size, fileName)
+        print("Wrote", len(table), "positions of size", size, "to", fileName)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import itertools
+import random
+from CubiCupDriver import BLUE
+from CubiCupDriver import GREEN
+from CubiCupDriver import cellIndex
+from CubiCupDriver import permuteMove
+
+# Topologies that have already been built, by board size
+topologies = {}
+
+
+# Get the topology for a board size, building it only the first time that size is asked for
+def getTopology(size):
+    topology = topologies.get(size)
+    if topology is None:
+        topology = Topology(size)
+        topologies[size] = topology
+    return topology
+
+
+# Tables describing how the cube spots of a board size relate to each other, all by flat (bit) index.
+# These never change for a size, so the rules look them up instead of recomputing coordinates and bounds.
+class Topology:
+
+    def __init__(self, size):
+        self.size = size
+        self.rowLength = size + 1
+        self.layerLength = self.rowLength * self.rowLength
+        self.numIndices = self.layerLength * self.rowLength
+
+        # x,y,z tuple of each index (None for indices outside the pyramid), and index of each x,y,z tuple
+        self.coords = [None for i in range(self.numIndices)]
+        self.indexOf = {}
+
+        # Indices of the cubes that can be played on (above the base), top to bottom
+        self.cells = []
+
+        # Bitboards of the base cubes and of the cubes that can be played on
+        self.baseMask = 0
+        self.cellMask = 0
+
+        # For each index, the three spots it sits on (empty for base and out of pyramid spots)
+        self.supports = [() for i in range(self.numIndices)]
+
+        # For each index, the spots it helps hold up in the -x, -y and -z directions, as
+        # (target index, target bit, bitboard of the other two spots target sits on) tuples.
+        # The target becomes a cup (and a move) once the other two spots are filled, and is a cup
+        # that must be filled once the other two spots are the same color as this one
+        self.cups = [() for i in range(self.numIndices)]
+
+        for depth in range(size + 1):
+            for x in range(depth + 1):
+                for y in range(depth - x + 1):
+                    z = depth - x - y
+                    index = cellIndex(size, x, y, z)
+                    self.coords[index] = (x, y, z)
+                    self.indexOf[(x, y, z)] = index
+
+                    if depth == size:
+                        self.baseMask |= 1 << index
+                        continue
+
+                    self.cells.append(index)
+                    self.cellMask |= 1 << index
+                    self.supports[index] = (index + self.layerLength, index + self.rowLength, index + 1)
+
+        for index in self.indexOf.values():
+            x, y, z = self.coords[index]
+            # Directions are always checked in -x, -y, -z order, the order cups are filled in matters
+            # once a player is about to run out of pieces
+            for coord, offset in ((x, self.layerLength), (y, self.rowLength), (z, 1)):
+                if coord > 0:
+                    target = index - offset
+                    partners = 0
+                    for below in self.supports[target]:
+                        if below != index:
+                            partners |= 1 << below
+                    self.cups[index] = self.cups[index] + ((target, 1 << target, partners),)
+
+        # For each index, a bitboard of the spots it helps hold up
+        self.aboveMask = [0 for i in range(self.numIndices)]
+        for index in self.indexOf.values():
+            for target, targetBit, partners in self.cups[index]:
+                self.aboveMask[index] |= targetBit
+
+        # The top cube, and the three spots it sits on, decide the end of the game
+        self.top = 0
+        self.topBit = 1
+        self.topSupportMask = 0
+        for index in self.supports[self.top]:
+            self.topSupportMask |= 1 << index
+
+        # Random 64 bit keys for Zobrist hashing, one for each color of cube at each index and one for green
+        # to move. A position's hash is the xor of the keys of its cubes (and the turn key), so it can be
+        # updated one cube at a time. Seeded by size, so every process and every run hashes positions the same
+        rng = random.Random(size)
+        self.zobrist = [[rng.getrandbits(64) for i in range(self.numIndices)] for color in (BLUE, GREEN)]
+        self.zobristTurn = rng.getrandbits(64)
+
+        # The pyramid and the rules look the same with x, y and z swapped around, so there are six
+        # orientations of every position, one for each permutation of the axes (identity first). For each
+        # permutation, the index each index moves to, and the Zobrist keys of the index it moves to
+        self.permutations = list(itertools.permutations(range(3)))
+        self.permutedIndex = []
+        self.permutedZobrist = []
+        for permutation in self.permutations:
+            permutedIndex = [0 for i in range(self.numIndices)]
+            for index in self.indexOf.values():
+                permutedIndex[index] = self.indexOf[permuteMove(self.coords[index], permutation)]
+            self.permutedIndex.append(permutedIndex)
+            self.permutedZobrist.append([[self.zobrist[color][permutedIndex[i]] for i in range(self.numIndices)]
+                                         for color in (BLUE, GREEN)])
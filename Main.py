@@ -1,11 +1,15 @@
 #!/usr/bin/python
 
+import sys
 import time
 import threading
 import CubiCupEngine
 
-# Create engine object
-engine = CubiCupEngine.Engine()
+# Create engine object, an optional first argument is the number of root parallel search processes
+if len(sys.argv) > 1:
+    engine = CubiCupEngine.Engine(rootWorkers=int(sys.argv[1]))
+else:
+    engine = CubiCupEngine.Engine()
 
 # Function to handle input to python program
 def inputHandler():
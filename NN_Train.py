@@ -1,8 +1,12 @@
 
 import NN_player
 import CubiCupGame
-import numpy as np
+import CubiCupBook
+import CubiCupShards
+import CubiCupReplay
+import CubiCupStream
 import multiprocessing
+import queue
 import Network
 from multiprocessing import Process
 
@@ -11,6 +15,10 @@ trainingSetGames = 2400
 trainingLoop = 1
 evaluationGames = 100
 gameSize = 5
+shardDirectory = "selfPlayShards"  # Self-play games are written here as they finish
+replayDirectory = "replayBuffer"  # Positions of the last generations are kept here to train on
+replayCapacity = 2000000
+replayWindow = 5  # Generations trained on
 
 
 def self_play_single(numGames=trainingSetGames, modelName=None):
@@ -24,21 +32,28 @@ def self_play_single(numGames=trainingSetGames, modelName=None):
     else:
         outputFunc = None
 
-    games = []
+    # Every game starts from the same position, start them from the opening book if one has been built
+    book = CubiCupBook.openBook(CubiCupBook.getBookName(gameSize))
+
+    # Games are written to shards as they finish, only the shards' manifests are kept
+    writer = CubiCupShards.ShardWriter(shardDirectory, "selfPlay_0", gameSize)
+    manifests = []
     for i in range(numGames):
 
         game = CubiCupGame.Game(gameSize)
 
-        selfPlayer = NN_player.Player(game, -1, simsPerMove, outputFunc)
+        selfPlayer = NN_player.Player(game, -1, simsPerMove, outputFunc, book=book)
         selfPlayer.play()
 
-        print("Saving game: ", len(games))
-        games.append(game)
+        print("Saving game: ", i)
+        manifests += writer.addGame(game)
 
-    return games
+    return manifests + writer.close()
 
 
-def self_play(gameQueue, numGames=trainingSetGames, modelName=None):
+# Play games, writing them to this worker's own shards, and put the manifest of each shard on manifestQueue as
+# it's finished. None is put on it once all the games are done
+def self_play(manifestQueue, numGames=trainingSetGames, modelName=None, worker=0):
 
     # Get model from name, then get output function so predicts can be done quickly
     if modelName is not None:
@@ -49,16 +64,24 @@ def self_play(gameQueue, numGames=trainingSetGames, modelName=None):
     else:
         outputFunc = None
 
+    book = CubiCupBook.openBook(CubiCupBook.getBookName(gameSize))
+
+    writer = CubiCupShards.ShardWriter(shardDirectory, "selfPlay_" + str(worker), gameSize)
     for i in range(numGames):
 
         game = CubiCupGame.Game(gameSize)
 
-        selfPlayer = NN_player.Player(game, -1, simsPerMove, outputFunc)
+        selfPlayer = NN_player.Player(game, -1, simsPerMove, outputFunc, book=book)
         selfPlayer.play()
 
-        gameQueue.put(game.history)
+        for manifest in writer.addGame(game):
+            manifestQueue.put(manifest)
         #print(len(gameQueue))
 
+    for manifest in writer.close():
+        manifestQueue.put(manifest)
+    manifestQueue.put(None)
+
 
 def self_play_threaded(modelName=None):
 
@@ -68,81 +91,56 @@ def self_play_threaded(modelName=None):
         threads = 1
 
     gamesPerThread = int(trainingSetGames / threads)
-    games = []
+    manifests = []
 
     print("Playing threaded")
     print("Threads: ", threads, "  gamesPerThread: ", gamesPerThread)
 
-    gameQueue = multiprocessing.Queue()
+    # Workers write their games to shards themselves, only the shards' manifests come back
+    manifestQueue = multiprocessing.Queue()
 
     gameThreads = []
     for i in range(threads):
-        gameThreads.append(Process(target=self_play, args=(gameQueue, gamesPerThread, modelName)))
+        gameThreads.append(Process(target=self_play, args=(manifestQueue, gamesPerThread, modelName, i)))
         gameThreads[i].start()
 
-    processesAlive = True
-    while processesAlive:
+    # Wait for every worker to say it's done, or to have died without saying so
+    workersDone = 0
+    while workersDone < threads:
 
         try:
-            gameToAdd = gameQueue.get_nowait()
-            if gameToAdd is not None:
-                print("Saving game: ", len(games))
-                games.append(gameToAdd)
-        except:
-            pass
-
-        processesAlive = False
-        for i in range(threads):
-            if gameThreads[i].is_alive():
-                processesAlive = True
+            manifest = manifestQueue.get(timeout=10)
+        except queue.Empty:
+            if not any(gameThread.is_alive() for gameThread in gameThreads):
                 break
+            continue
 
-    return games
-
-
-def createSets(games):
-
-    xTrain = []
-    yTrain = []
-    xTest = []
-    yTest = []
-
-    for i in range(len(games)):
+        if manifest is None:
+            workersDone += 1
+        else:
+            print("Saved shard: ", manifest["fileName"], "  games: ", manifest["games"])
+            manifests.append(manifest)
 
-        game = games[i]
+    for gameThread in gameThreads:
+        gameThread.join()
 
-        #scoreList = [[[game.endValue for x in range(gameSize + 1)] for y in range(gameSize + 1)] for z in range(gameSize + 1)]
+    return manifests
 
-        if i < len(games)*4/5:
-            for element in game:
-                xTrain.append(element[0].board)
-                yTrain.append(element[1])
-        else:
-            for element in game:
-                xTest.append(element[0].board)
-                yTest.append(element[1])
 
-    #print("training sets")
-    #for i in range(len(xTrain)):
-    #    print("x: " + str(xTrain[i]))
-    #    print("y: " + str(yTrain[i]))
+# Create training and test sets from the replay buffer's window of generations, a fifth of the positions are
+# for testing. They're streams of batches, read from the buffer as training goes, with training positions
+# turned a random way each time they're used. The test set is None if the window is too small to have any
+def createSets(replayBuffer):
 
-    #print("testing sets")
-    #for i in range(len(xTest)):
-    #    print("x: " + str(xTest[i]))
-    #    print("y: " + str(yTest[i]))
+    trainIndices, testIndices = replayBuffer.split()
 
-    xTrain = np.array(xTrain)
-    yTrain = np.array(yTrain)
-    xTest = np.array(xTest)
-    yTest = np.array(yTest)
-
-    xTrain = xTrain.reshape((xTrain.shape[0], 1, xTrain.shape[1], xTrain.shape[2], xTrain.shape[3]))
-    yTrain = yTrain.reshape((yTrain.shape[0], 1, yTrain.shape[1], yTrain.shape[2], yTrain.shape[3]))
-    xTest = xTest.reshape((xTest.shape[0], 1, xTest.shape[1], xTest.shape[2], xTest.shape[3]))
-    yTest = yTest.reshape((yTest.shape[0], 1, yTest.shape[1], yTest.shape[2], yTest.shape[3]))
+    trainStream = CubiCupStream.BatchStream(replayBuffer, trainIndices, augment="random")
+    if len(testIndices) > 0:
+        testStream = CubiCupStream.BatchStream(replayBuffer, testIndices, shuffle=False)
+    else:
+        testStream = None
 
-    return xTrain, yTrain, xTest, yTest
+    return trainStream, testStream
 
 
 def train():
@@ -152,21 +150,23 @@ def train():
 
     currentModelName = "currentModel_"+str(gameSize)+".h5"
 
-    # Create self play games
-    selfPlayGamesSave = self_play_threaded(modelName=None)
-    #selfPlayGamesSave = self_play_single(modelName=currentModelName)
+    # Create self play games, written to shards
+    selfPlayShards = self_play_threaded(modelName=None)
+    #selfPlayShards = self_play_single(modelName=currentModelName)
 
-    # Creating sets from games
-    xTrain, yTrain, xTest, yTest = createSets(selfPlayGamesSave)
+    # Add the games to the replay buffer as its next generation, and create sets from its last generations
+    replayBuffer = CubiCupReplay.ReplayBuffer(replayDirectory, gameSize, replayCapacity, replayWindow)
+    replayBuffer.addShards(selfPlayShards, replayBuffer.generation + 1)
+    trainStream, testStream = createSets(replayBuffer)
 
     # Load current model, train it, then save it
     currentModel = Network.getModel(currentModelName, inputShape, policyShape)
-    model = Network.trainResNet(xTrain, yTrain, xTest, yTest, currentModel)
+    model = Network.trainResNet(trainStream, None, testStream, None, currentModel)
     currentModel.save(currentModelName)
 
-    xTestS = xTest[0].reshape(1, 1, xTest.shape[2], xTest.shape[3], xTest.shape[4])
-    yTestS = yTest[0].reshape(1, 1, yTest.shape[2], yTest.shape[3], yTest.shape[4])
-    Network.model_test(xTestS, yTestS, currentModel)
+    if testStream is not None:
+        xTestS, yTestS, resultTestS = replayBuffer.gather(testStream.indices[:1])
+        Network.model_test(xTestS, yTestS, currentModel)
 
 
 def evaluate():
@@ -188,8 +188,7 @@ def evaluate():
 
         currentPlayer = NN_player.Player(game, 0, simsPerMove, outputFuncCurrent)
         bestPlayer = NN_player.Player(game, 1, simsPerMove, outputFuncBest)
-        currentPlayer.play()
-        bestPlayer.play()
+        NN_player.playGame(game)
 
         if game.endValue == 1:
             currentPlayerScore = currentPlayerScore + 1
@@ -202,8 +201,7 @@ def evaluate():
 
         currentPlayer = NN_player.Player(game, 1, simsPerMove, outputFuncCurrent)
         bestPlayer = NN_player.Player(game, 0, simsPerMove, outputFuncBest)
-        currentPlayer.play()
-        bestPlayer.play()
+        NN_player.playGame(game)
 
         if game.endValue == -1:
             currentPlayerScore = currentPlayerScore + 1
@@ -6,11 +6,15 @@ import Network
 
 class Player:
 
-    def __init__(self, game, player=-1, simsPerMove=1600, outputFunc=None):
+    # With threaded, the search runs in its own thread the whole game, searching on the other players'
+    # turns too. Otherwise it only searches on this player's turns, in the thread taking them. With book (a
+    # CubiCupBook), the first moves start from the book's searches
+    def __init__(self, game, player=-1, simsPerMove=1600, outputFunc=None, threaded=False, book=None):
 
         self.game = game
         self.player = player  # -1 means all players, otherwise should be set to player number
         self.simsPerMove = simsPerMove
+        self.threaded = threaded
 
         # Join game
         self.game.join(self)
@@ -20,15 +24,33 @@ class Player:
 
 
 
-        self.mcts = CubiCupMCTS.MCTS(self.game.size, moveProbFunc=outputFunc)
+        self.mcts = CubiCupMCTS.MCTS(self.game.size, moveProbFunc=outputFunc, book=book)
 
         #print("creating player")
 
     def update(self, move):
-        self.mcts.updateWithTurn(move)
+        if self.threaded:
+            self.mcts.updateWithTurn(move)
+        else:
+            self.mcts.advance(move)
+
+    def isTurn(self):
+        return self.game.state.turn == self.player or self.player == -1
+
+    # Search in this thread and take a turn with the best move
+    def takeTurn(self):
+        bestMove, score, sims, moveProbs = self.mcts.search(self.simsPerMove)
+        self.game.takeTurn(bestMove, self.mcts.getRootVisits())
 
     def play(self):
 
+        # Without a search thread, take turns until the game is over or it's another player's turn,
+        # see playGame for games between players
+        if not self.threaded:
+            while not self.game.state.gameOver and self.isTurn():
+                self.takeTurn()
+            return
+
         #print("playing")
 
         # Start mcts in thread
@@ -37,34 +59,48 @@ class Player:
         mctsThread.start()
         #print("starting mcts")
 
-        # If sims number reached (or game is terminal) and it's this players turn, take turn
+        # Wait for the search instead of polling it: on this player's turn until it reaches simsPerMove
+        # (or can't search any further), otherwise until another player's move reaches it
         while True:
-            if (self.mcts.root.sims >= self.simsPerMove or self.mcts.root.isTerminal) \
-                    and (self.mcts.root.state.turn == self.player or self.player == -1):
+
+            root = self.mcts.root
+
+            # If game is over, stop the mcts and break out of loop
+            if root.state.gameOver:
+                self.mcts.end()
+                mctsThread.join()
+                #print("game over")
+                break
+
+            if root.state.turn == self.player or self.player == -1:
+
+                self.mcts.setSimulationTarget(self.simsPerMove)
+                self.mcts.waitForSimulationTarget()
 
                 # Pause mcts while we take turn and get move probabilities
                 self.mcts.setPause()
-                while True:
-                    if self.mcts.isPaused:
-                        break
+                self.mcts.waitForPause()
 
                 bestChild = self.mcts.root.getBestChild()
-                bestMove = bestChild.state.lastMove
+                bestMove = self.mcts.toGameMove(self.mcts.root.getChildMove(bestChild))
                 #print("taking turn " + str(bestMove))
-                self.game.takeTurn(bestMove, self.mcts.root.getMoveProbabilities())
+                self.game.takeTurn(bestMove, self.mcts.getRootVisits())
 
                 # Wait until mcts has updated root, then let it continue
-                while True:
-                    if not self.mcts.newRootReady:
-                        break
+                self.mcts.waitForRootUpdate()
                 self.mcts.setPlay()
 
-            # If game is over, stop the mcts and break out of loop
-            if self.mcts.root.state.gameOver:
-                self.mcts.end()
-                mctsThread.join()
-                #print("game over")
-                break
+            else:
+                self.mcts.waitForNewRoot(root)
 
         # return all info to be saved, moves
 
+
+# Play a game out between the players that joined it, each taking its own turns. Players need to not be
+# threaded, threaded players each play a game with play() in their own thread instead
+def playGame(game):
+    while not game.state.gameOver:
+        for player in game.players:
+            if player.isTurn():
+                player.takeTurn()
+                break
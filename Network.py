@@ -1,6 +1,20 @@
 
 import CubiCupDriver
+import CubiCupInference
+import CubiCupTopology
+import collections
+import itertools
+import threading
 import time
+from CubiCupDriver import invertPermutation
+from CubiCupDriver import permuteMove
+
+# Move probabilities the network has already given, by (output function, board size, canonical position hash),
+# least recently used first. Shared by every search in the process, so positions seen again in the tree or in
+# a later game (or turned some other way) don't need the network again
+priorCache = collections.OrderedDict()
+priorCacheSize = 200000
+priorCacheLock = threading.Lock()
 
 
 def lr_schedule(epoch):
@@ -138,12 +152,17 @@ def getModel(name, inputShape=None, policyShape=None):
     return model
 
 
+# Train model on xTrain and yTrain, validating on xTest and yTest. Either arrays of network inputs and outputs, or
+# xTrain and xTest can be CubiCupStream.BatchStreams (yTrain and yTest then None), reading batches as training
+# goes, so the training data never has to fit in memory. Without test positions (xTest None) there's no
+# validation
 def trainResNet(xTrain, yTrain, xTest, yTest, model):
 
     from tensorflow.keras.callbacks import LearningRateScheduler
     from tensorflow.keras.callbacks import ReduceLROnPlateau
     import numpy as np
     import time
+    import CubiCupStream
 
     # Training parameters
     BATCH_SIZE = 128
@@ -154,19 +173,38 @@ def trainResNet(xTrain, yTrain, xTest, yTest, model):
     # Prepare callbacks for model saving and for learning rate adjustment.
     lr_scheduler = LearningRateScheduler(lr_schedule)
 
-    lr_reducer = ReduceLROnPlateau(factor=np.sqrt(0.1),
+    # Without test positions the learning rate is lowered from the training loss instead
+    validate = xTest is not None and len(xTest) > 0
+
+    lr_reducer = ReduceLROnPlateau(monitor="val_loss" if validate else "loss",
+                                   factor=np.sqrt(0.1),
                                    cooldown=0,
                                    patience=5,
                                    min_lr=0.5e-6)
 
     callbacks = [lr_reducer, lr_scheduler]
 
-    model.fit(xTrain, yTrain,
-              batch_size=BATCH_SIZE,
-              epochs=EPOCHS,
-              validation_data=(xTest, yTest),
-              shuffle=True,
-              callbacks=callbacks)
+    if isinstance(xTrain, CubiCupStream.BatchStream):
+        # The streams batch and shuffle themselves
+        if validate:
+            model.fit(iter(xTrain),
+                      steps_per_epoch=len(xTrain),
+                      epochs=EPOCHS,
+                      validation_data=iter(xTest),
+                      validation_steps=len(xTest),
+                      callbacks=callbacks)
+        else:
+            model.fit(iter(xTrain),
+                      steps_per_epoch=len(xTrain),
+                      epochs=EPOCHS,
+                      callbacks=callbacks)
+    else:
+        model.fit(xTrain, yTrain,
+                  batch_size=BATCH_SIZE,
+                  epochs=EPOCHS,
+                  validation_data=(xTest, yTest) if validate else None,
+                  shuffle=True,
+                  callbacks=callbacks)
 
     elapsed_time = time.time() - start_time
     print("Elapsed time: ", elapsed_time)
@@ -182,20 +220,69 @@ def getOutputFunc(model):
     return get_output
 
 
-def getMoveProbs(state, outputFunc):
+# An output function averaging outputFunc's predictions over every way the board's axes can be permuted. Each
+# position is turned all six ways, all of them go to outputFunc in one call, and each prediction is turned back
+# before they're averaged. Can be passed anywhere an output function is, or to an InferenceBatcher, so whole
+# batches are averaged in one call
+class SymmetricOutputFunc:
+
+    permutations = list(itertools.permutations(range(3)))
+
+    def __init__(self, outputFunc):
+        self.outputFunc = outputFunc
+
+    def __call__(self, inputs):
+
+        import numpy as np
+
+        boards = np.asarray(inputs[0])
+        count = len(boards)
+
+        # Axes of inputs and outputs are (position, channel, x, y, z), only the last three are permuted
+        turned = np.concatenate([boards.transpose(0, 1, 2 + p[0], 2 + p[1], 2 + p[2]) for p in self.permutations])
+        predictions = self.outputFunc([turned])[0]
+
+        average = np.zeros(predictions[:count].shape, dtype=predictions.dtype)
+        for i in range(len(self.permutations)):
+            inverse = invertPermutation(self.permutations[i])
+            prediction = predictions[i * count:(i + 1) * count]
+            average += prediction.transpose(0, 1, 2 + inverse[0], 2 + inverse[1], 2 + inverse[2])
+
+        return [average / len(self.permutations)]
+
+
+# Get the network's probability of each of moves (the state's available moves if not given) being played. If
+# symmetric is set, the probabilities are averaged over the position turned every way, in one call
+def getMoveProbs(state, outputFunc, moves=None, symmetric=False):
+
+    if symmetric:
+        if isinstance(outputFunc, CubiCupInference.InferenceBatcher):
+            # Batched positions are averaged by giving the batcher a SymmetricOutputFunc in the first place, one
+            # that wasn't would give plain probabilities
+            if not isinstance(outputFunc.outputFunc, SymmetricOutputFunc):
+                raise ValueError("Symmetric probabilities need an InferenceBatcher of a SymmetricOutputFunc")
+        elif not isinstance(outputFunc, SymmetricOutputFunc):
+            outputFunc = SymmetricOutputFunc(outputFunc)
+
+    if isinstance(outputFunc, CubiCupInference.InferenceBatcher):
+        # Batched with other positions, this waits for the batch to run
+        return outputFunc.getMoveProbs(state, moves)
 
     import numpy as np
 
     #start_time = time.time()
 
     size = state.boardSize+1
-    boardInput = np.array(state.board).reshape(1, 1, size, size, size)
+    boardInput = np.array(state.getBoardArray()).reshape(1, 1, size, size, size)
 
     movePredictions = outputFunc([boardInput])[0]
     #movePredictions = model.predict(boardInput)  # slow version, output func is obtained through getOutputFunc(model)
 
+    if moves is None:
+        moves = state.availableMoves
+
     availableMoveProbs = []
-    for move in state.availableMoves:
+    for move in moves:
         x = move[0]
         y = move[1]
         z = move[2]
@@ -212,8 +299,10 @@ def getMoveProbs(state, outputFunc):
 
 def model_test(xTest, yTest, model):
 
+    size = len(xTest[0][0]) - 1
     availableMoves = []
-    CubiCupDriver.getAvailableMoves(xTest[0][0], 5, availableMoves)
+    CubiCupDriver.getAvailableMoves(CubiCupDriver.boardFromArray(xTest[0][0], size),
+                                    CubiCupTopology.getTopology(size), availableMoves)
 
     yPredict = model.predict(xTest)
 
@@ -230,3 +319,29 @@ def model_test(xTest, yTest, model):
     print("a: ", availableMoves)
     print("p: ", availableMoveProbs)
 
+
+# Same as getMoveProbs, but looked up in priorCache first. The cache keeps probabilities by move in the
+# position's canonical orientation, so they're turned to match state's orientation on the way out
+def getCachedMoveProbs(state, outputFunc, moves=None):
+
+    if moves is None:
+        moves = state.availableMoves
+
+    canonicalHash, permutation = state.getCanonical()
+    key = (outputFunc, state.boardSize, canonicalHash)
+
+    with priorCacheLock:
+        canonicalProbs = priorCache.get(key)
+        if canonicalProbs is not None:
+            priorCache.move_to_end(key)
+
+    if canonicalProbs is None:
+        probs = getMoveProbs(state, outputFunc, moves)
+        canonicalProbs = {permuteMove(moves[i], permutation): probs[i] for i in range(len(moves))}
+
+        with priorCacheLock:
+            priorCache[key] = canonicalProbs
+            while len(priorCache) > priorCacheSize:
+                priorCache.popitem(last=False)
+
+    return [canonicalProbs[permuteMove(move, permutation)] for move in moves]